@@ -3,6 +3,14 @@ from ultralytics import YOLO
 import cv2
 import numpy as np
 import os
+from increase_resolution_Rdy import open_mosaic
+from model_registry_Rdy import registry
+from text_embeddings_Rdy import text_embeddings
+from batched_slicer_Rdy import BatchedSlicer
+from backends_Rdy import resolve_weights, is_exported, load_segment_backend, export_weights
+from inference_server_Rdy import InferenceClient, model_infer
+from detection_store_Rdy import DetectionStore
+from result_cache_Rdy import content_digest
 try:
     from IPython import display
 except ImportError:
@@ -15,16 +23,50 @@ except ImportError:
 
 
 class Model_InsSeg:
-    def __init__(self):
+    def __init__(self, batch_size=8, result_cache=None, server_url=None, merge="nms",
+                 store_dir="structure_folder/detection_store"):
+        self.batch_size = batch_size
+        # DetectionStore per image: boxes as columns, masks run-length encoded; None keeps nothing
+        self.store_dir = store_dir
+        # How overlapping slice detections are merged: "nms", "soft-nms" or "wbf"
+        self.merge = merge
+        # Inference server: forward passes run in a long-lived process that keeps the weights loaded
+        self.server = InferenceClient(server_url) if server_url else None
+        # DetectionCache: unchanged image, weights and slicing return stored masks and boxes
+        self.result_cache = result_cache
         self.base_model_path = "structure_folder/Model_InsSeg.pt"
         self.upgraded_model_path = "structure_folder/models_folder/Upgraded_Model_InsSeg.pt"
         os.makedirs("structure_folder/models_folder", exist_ok=True)
     
-    def _get_model(self):
-        """Get the best available model"""
+    def _weights_path(self):
+        """Get the path of the best available weights"""
         if os.path.exists(self.upgraded_model_path):
-            return YOLO(self.upgraded_model_path)
-        return YOLO(self.base_model_path)
+            return self.upgraded_model_path
+        return self.base_model_path
+    
+    def _get_model(self, classes=None, local=False):
+        """Get the best available model, shared through the model registry"""
+        if self.server is not None and not local:
+            return self.server.model("segment", classes)
+        if not classes:
+            return registry.get(self._weights_path(), YOLO)
+        
+        # Custom vocabularies are cached separately so set_classes never leaks into predict
+        return registry.get(
+            self._weights_path(), YOLO,
+            variant=tuple(classes),
+            # YOLOWorld weights reuse cached text embeddings; YOLOE encodes through its own prompt head
+            setup=lambda model: text_embeddings.set_classes(model, classes)
+        )
+    
+    def _get_inference_model(self):
+        """Get the exported CPU backend when it is fresher than the .pt, else the .pt model"""
+        if self.server is not None:
+            return self.server.model("segment")
+        weights_path = resolve_weights(self._weights_path())
+        if is_exported(weights_path):
+            return registry.get(weights_path, load_segment_backend)
+        return registry.get(weights_path, YOLO)
     
     def _validate_image_path(self, img_path):
         """Validate image path to prevent path traversal"""
@@ -32,23 +74,65 @@ class Model_InsSeg:
             return False
         return True
     
-    def _process_segmentation(self, model, img_path):
-        """Common segmentation processing logic"""
+    def _segment(self, model, image, img_path, weights_path):
+        """Run batched sliced segmentation, or return the cached result"""
+        key = None
+        if self.result_cache is not None and weights_path is not None:
+            # Slicing settings alone make the key, so a cache hit never loads the weights
+            settings = BatchedSlicer(None, batch_size=self.batch_size, merge=self.merge)
+            key = self.result_cache.key(img_path, weights_path, None, settings, task="segment")
+            detections = self.result_cache.get(key)
+            if detections is not None:
+                return detections
+        
+        if model is None:
+            model = self._get_inference_model()
+        detections = BatchedSlicer(model_infer(model), batch_size=self.batch_size, merge=self.merge)(image)
+        if key is not None:
+            self.result_cache.put(key, detections)
+        return detections
+    
+    def _save_detections(self, img_path, detections, image_wh, source_wh):
+        """Keep an image's segmentation results in its own detection store, replacing older ones"""
+        # Resolution always writes image.png, so the name alone would make every run share one store
+        stem = os.path.splitext(os.path.basename(os.path.normpath(img_path)))[0]
+        store_path = os.path.join(self.store_dir, f"{stem}-{content_digest(img_path)[:12]}")
+        with DetectionStore(store_path, mode="w") as store:
+            # Boxes and masks are in the pixels of the resized image the model saw
+            store.set_info(source=os.path.abspath(img_path), image_wh=list(image_wh), source_wh=list(source_wh),
+                           scale=round(image_wh[0] / source_wh[0], 6))
+            store.append(detections)
+        print(f"Detections saved in <{store_path}>")
+        return store_path
+    
+    def _load_image(self, img_path):
+        """Load an image at the 640 px model input size, with its original (width, height); .npy is read at a stride"""
         if not self._validate_image_path(img_path):
             raise ValueError("Invalid image path")
         
-        image = cv2.imread(img_path)
-        if image is None:
-            raise ValueError("Failed to load image")
+        if img_path.endswith('.npy'):
+            # Full-resolution masks of a city-scale mosaic would not fit in memory, so
+            # segmentation sees the same 640 px overview as it does for image.png
+            mosaic = open_mosaic(img_path)
+            source_wh = (mosaic.shape[1], mosaic.shape[0])
+            step = max(1, max(mosaic.shape[:2]) // 640)
+            # Mosaics are stored RGB; cv2 images are BGR
+            image = np.ascontiguousarray(mosaic[::step, ::step, ::-1])
+        else:
+            image = cv2.imread(img_path)
+            if image is None:
+                raise ValueError("Failed to load image")
+            source_wh = (image.shape[1], image.shape[0])
         
-        image = sv.resize_image(image=image, resolution_wh=(640, 640), keep_aspect_ratio=True)
-        
-        def callback(image_slice: np.ndarray) -> sv.Detections:
-            result = model(image_slice)[0]
-            return sv.Detections.from_ultralytics(result)
+        return sv.resize_image(image=image, resolution_wh=(640, 640), keep_aspect_ratio=True), source_wh
+    
+    def _process_segmentation(self, model, img_path, weights_path=None):
+        """Common segmentation processing logic"""
+        image, source_wh = self._load_image(img_path)
         
-        slicer = sv.InferenceSlicer(callback=callback)
-        detections = slicer(image)
+        detections = self._segment(model, image, img_path, weights_path)
+        if self.store_dir:
+            self._save_detections(img_path, detections, (image.shape[1], image.shape[0]), source_wh)
         
         mask_annotator = sv.MaskAnnotator()
         label_annotator = sv.LabelAnnotator(text_position=sv.Position.CENTER_OF_MASS)
@@ -72,6 +156,7 @@ class Model_InsSeg:
                 raise RuntimeError("Training failed")
             
             model.save(self.upgraded_model_path)
+            registry.invalidate(self.upgraded_model_path)
             print(f"Model saved in <{self.upgraded_model_path}>")
             return "Done"
             
@@ -82,8 +167,8 @@ class Model_InsSeg:
     def define_custom_classes(self, order):
         """Define custom classes for segmentation"""
         try:
-            model = self._get_model()
-            model.set_classes(order)
+            # Saving needs the weights in this process, even when inference goes to a server
+            model = self._get_model(order, local=True)
             
             save_path = (self.upgraded_model_path.replace('.pt', '_Defined.pt') 
                         if os.path.exists(self.upgraded_model_path) 
@@ -100,9 +185,27 @@ class Model_InsSeg:
     def predict(self, img_path):
         """Predict instance segmentation"""
         try:
-            model = self._get_model()
-            return self._process_segmentation(model, img_path)
+            return self._process_segmentation(None, img_path, resolve_weights(self._weights_path()))
             
         except Exception as e:
             print(f"Prediction error: {e}")
+            return ""
+
+    def export(self, fmt='openvino', int8=False, calibration_yaml=None):
+        """Export every available weight file to an optimized CPU runtime"""
+        try:
+            weights = [self.base_model_path, self.upgraded_model_path,
+                       self.base_model_path.replace('.pt', '_Defined.pt'),
+                       self.upgraded_model_path.replace('.pt', '_Defined.pt')]
+            weights = [path for path in weights if os.path.exists(path)]
+            if not weights:
+                raise ValueError("No model weights to export")
+            
+            for pt_path in weights:
+                exported = export_weights(pt_path, fmt=fmt, int8=int8, data=calibration_yaml)
+                print(f"Exported <{pt_path}> to <{exported}>")
+            return "Done"
+            
+        except Exception as e:
+            print(f"Export error: {e}")
             return ""
\ No newline at end of file
@@ -3,6 +3,18 @@ import cv2
 from ultralytics import YOLOWorld, YOLO
 import numpy as np
 import os
+import json
+import time
+from increase_resolution_Rdy import open_mosaic, Pyramid
+from model_registry_Rdy import registry
+from text_embeddings_Rdy import text_embeddings
+from batched_slicer_Rdy import BatchedSlicer
+from video_pipeline_Rdy import VideoPipeline, FrameGate
+from backends_Rdy import resolve_weights, is_exported, load_detect_backend, export_weights, compare_detections
+from journal_Rdy import JobJournal
+from result_cache_Rdy import content_digest
+from inference_server_Rdy import InferenceClient, model_infer
+from sharded_inference_Rdy import ShardPool, ShardedSlicer
 try:
     from IPython import display
 except ImportError:
@@ -15,18 +27,71 @@ except ImportError:
 
 
 class Model:
-    def __init__(self):
+    def __init__(self, batch_size=8, track_batch_size=4, queue_size=16, resume=False, result_cache=None,
+                 prefilter=None, server_url=None, shard_workers=0, merge="nms"):
+        self.batch_size = batch_size
+        # How overlapping slice detections are merged: "nms", "soft-nms" or "wbf"
+        self.merge = merge
+        # ShardPool: slices of one large image run in worker processes that each hold the model
+        self.shard_pool = ShardPool(shard_workers, batch_size) if shard_workers > 1 else None
+        # Inference server: forward passes run in a long-lived process that keeps the weights loaded
+        self.server = InferenceClient(server_url) if server_url else None
+        # DetectionCache: unchanged image, weights, classes and slicing return stored results
+        self.result_cache = result_cache
+        # SliceFilter: slices of water, cloud or bare field skip the network
+        self.prefilter = prefilter
+        # Journal finished slices so an interrupted run over a big mosaic continues where it stopped
+        self.resume = resume
+        self.track_batch_size = track_batch_size
+        self.queue_size = queue_size
+        # Adaptive tracking: detector on every Nth frame or when the frame difference passes the threshold
+        self.keyframe_interval = 5
+        self.motion_threshold = 8.0
+        self.audit_interval = 0
         self.base_model_path = "structure_folder/Model.pt"
         self.upgraded_model_path = "structure_folder/models_folder/Upgraded_Model.pt"
         os.makedirs("structure_folder/models_folder", exist_ok=True)
         os.makedirs("structure_folder/CSV_folder", exist_ok=True)
         os.makedirs("structure_folder/video_tracked", exist_ok=True)
     
-    def _get_model(self):
-        """Get the best available model"""
+    def close(self):
+        """Stop the shard worker processes, if any; the model can still be used in-process"""
+        if self.shard_pool is not None:
+            self.shard_pool.close()
+    
+    def _weights_path(self):
+        """Get the path of the best available weights"""
         if os.path.exists(self.upgraded_model_path):
-            return YOLOWorld(self.upgraded_model_path)
-        return YOLOWorld(self.base_model_path)
+            return self.upgraded_model_path
+        return self.base_model_path
+    
+    def _get_model(self, classes=None, local=False):
+        """Get the best available model, shared through the model registry"""
+        if self.server is not None and not local:
+            return self.server.model("detect", classes)
+        if not classes:
+            return registry.get(self._weights_path(), YOLOWorld)
+        
+        # Custom vocabularies are cached separately so set_classes never leaks into predict
+        return registry.get(
+            self._weights_path(), YOLOWorld,
+            variant=tuple(classes),
+            # Only class names never encoded before go through the text encoder
+            setup=lambda model: text_embeddings.set_classes(model, classes)
+        )
+    
+    def _get_inference_model(self, loader=YOLOWorld):
+        """Get the exported CPU backend when it is fresher than the .pt, else the .pt model"""
+        if self.server is not None:
+            return self.server.model("detect")
+        weights_path = resolve_weights(self._weights_path())
+        if is_exported(weights_path):
+            return registry.get(weights_path, load_detect_backend)
+        return registry.get(weights_path, loader)
+    
+    def _model_for(self, classes=None):
+        """Get the custom-vocabulary model, or the inference backend when no classes are given"""
+        return self._get_model(classes) if classes else self._get_inference_model()
     
     def _validate_image_path(self, img_path):
         """Validate image path"""
@@ -34,23 +99,115 @@ class Model:
             return False
         return True
     
-    def _process_image(self, model, img_path):
-        """Common image processing logic"""
+    def _load_image(self, img_path):
+        """Load an image for detection: .npy mosaics stay memory-mapped at full resolution, others are resized to 640"""
         if not self._validate_image_path(img_path):
             raise ValueError("Invalid image path")
         
-        image = cv2.imread(img_path)
+        # Full resolution is the point of an out-of-core mosaic, so the same area finds more and
+        # smaller objects from image.npy than from the 640 px image.png or pyramid overview
+        if img_path.endswith('.npy'):
+            return open_mosaic(img_path), True
+        
+        if os.path.isdir(img_path):
+            # Tiled pyramid: decode only the overview level closest to the model input
+            pyramid = Pyramid(img_path)
+            image = np.ascontiguousarray(pyramid.read_level(pyramid.level_for(640))[..., ::-1])
+        else:
+            image = cv2.imread(img_path)
         if image is None:
             raise ValueError("Failed to load image")
         
-        image = sv.resize_image(image=image, resolution_wh=(640, 640), keep_aspect_ratio=True)
+        return sv.resize_image(image=image, resolution_wh=(640, 640), keep_aspect_ratio=True), False
+    
+    def _preview(self, image, detections, max_side=640):
+        """Downsample a mapped mosaic for display and scale detections to match"""
+        step = max(1, int(np.ceil(max(image.shape[:2]) / max_side)))
+        preview = np.ascontiguousarray(image[::step, ::step, ::-1])
+        detections.xyxy = detections.xyxy / step
+        return preview, detections
+    
+    def _slice_infer(self, model, mapped):
+        """Build the batch inference function used on image slices"""
+        infer = model_infer(model)
+        if not mapped:
+            return infer
+        
+        # Mosaics are stored RGB; flip each window to the BGR order cv2 images use
+        return lambda images: infer([np.ascontiguousarray(image[..., ::-1]) for image in images])
+    
+    def _slicer(self, model, mapped, classes=None, sharded=True):
+        """Build the slicer for one image, sharded across worker processes when a pool is configured"""
+        if sharded and self.shard_pool is not None and self.server is None:
+            return ShardedSlicer(self.shard_pool, classes, mapped, prefilter=self.prefilter, merge=self.merge)
+        return BatchedSlicer(self._slice_infer(model, mapped), batch_size=self.batch_size,
+                             prefilter=self.prefilter, merge=self.merge)
+    
+    def _open_journal(self, img_path, weights_path, classes, slicer):
+        """Open the journal of one image, weights, vocabulary and slicing combination"""
+        # Keyed on content, so re-stitching the same tiles does not orphan the finished slices
+        return JobJournal({
+            "stage": "infer",
+            "image": os.path.abspath(img_path),
+            "image_digest": content_digest(img_path),
+            "weights": os.path.abspath(weights_path),
+            "weights_digest": content_digest(weights_path),
+            "classes": list(classes) if classes else None,
+            "slice_wh": slicer.slice_wh,
+            "overlap_wh": slicer.overlap_wh,
+            "prefilter": slicer.prefilter.params() if slicer.prefilter is not None else None
+        })
+    
+    def _cache_key(self, img_path, weights_path, classes):
+        """Result cache key, built from the slicing settings without loading the model"""
+        settings = BatchedSlicer(None, batch_size=self.batch_size, prefilter=self.prefilter, merge=self.merge)
+        return self.result_cache.key(img_path, weights_path, classes, settings)
+    
+    def _detect(self, model, image, mapped, img_path=None, weights_path=None, classes=None):
+        """Run batched sliced inference over the whole image, or return the cached result"""
+        key = None
+        if self.result_cache is not None and img_path is not None and weights_path is not None:
+            key = self._cache_key(img_path, weights_path, classes)
+            detections = self.result_cache.get(key)
+            if detections is not None:
+                return detections
+        
+        # A model of None is loaded here, so a cache hit never pays for loading the weights
+        if model is None:
+            model = self._model_for(classes)
+        # Workers load the weights _get_model picks, so only calls that name those weights are sharded
+        slicer = self._slicer(model, mapped, classes, sharded=weights_path is not None)
+        if img_path is None or weights_path is None:
+            return slicer(image)
         
-        def callback(image_slice: np.ndarray) -> sv.Detections:
-            result = model(image_slice)[0]
-            return sv.Detections.from_ultralytics(result)
+        detections = self._run_slicer(slicer, image, img_path, weights_path, classes)
+        if key is not None:
+            self.result_cache.put(key, detections)
+        return detections
+    
+    def _run_slicer(self, slicer, image, img_path, weights_path, classes):
+        """Run the slicer, journaling finished slices when resuming is enabled"""
+        if not self.resume:
+            return slicer(image)
         
-        slicer = sv.InferenceSlicer(callback=callback)
-        detections = slicer(image)
+        journal = self._open_journal(img_path, weights_path, classes, slicer)
+        detections = slicer(image, journal)
+        if journal.resumed:
+            print(f"Resumed {journal.resumed} slices from an interrupted run")
+        journal.complete()
+        return detections
+    
+    def _process_image(self, model, img_path, weights_path=None, classes=None):
+        """Common image processing logic"""
+        image, mapped = self._load_image(img_path)
+        if self.prefilter is not None:
+            self.prefilter.reset()
+        detections = self._detect(model, image, mapped, img_path, weights_path, classes)
+        if self.prefilter is not None and self.prefilter.skipped:
+            print(f"Pre-filter skipped {len(self.prefilter.skipped)}/{self.prefilter.checked} slices")
+        
+        if mapped:
+            image, detections = self._preview(image, detections)
         
         box_annotator = sv.BoxAnnotator()
         label_annotator = sv.LabelAnnotator()
@@ -60,33 +217,25 @@ class Model:
         display.display(annotated_image)
         return "Done"
     
-    def _track_video(self, model, video_path):
-        """Common video tracking logic"""
-        frames_generator = sv.get_video_frames_generator(video_path)
-        
-        with sv.CSVSink("structure_folder/CSV_folder/Output_Track_on_Video.csv") as sink:
-            for frame in frames_generator:
-                results = model(frame)[0]
-                detections = sv.Detections.from_ultralytics(results)
-                sink.append(detections, {})
+    def _track_video(self, model, video_path, adaptive=False, columnar=False):
+        """Common video tracking logic: decode, inference and encode run as pipelined stages"""
+        csv_path = "structure_folder/CSV_folder/Output_Track_on_Video.csv"
+        # Columnar: detections go to a DetectionStore readable by frame range instead of the CSV
+        store_path = "structure_folder/CSV_folder/Output_Track_on_Video" if columnar else None
+        target_path = "structure_folder/video_tracked/result.mp4"
         
-        print("CSV-File saved in <structure_folder/CSV_folder/Output_Track_on_Video.csv>")
+        gate = FrameGate(self.keyframe_interval, self.motion_threshold) if adaptive else None
+        pipeline = VideoPipeline(model_infer(model), batch_size=self.track_batch_size,
+                                 queue_size=self.queue_size, gate=gate, audit_interval=self.audit_interval)
+        report = pipeline.run(video_path, csv_path, target_path, store_path)
         
-        tracker = sv.ByteTrack()
-        box_annotator = sv.BoxAnnotator()
-        
-        def callback(frame: np.ndarray, _: int) -> np.ndarray:
-            results = model(frame)[0]
-            detections = sv.Detections.from_ultralytics(results)
-            detections = tracker.update_with_detections(detections)
-            return box_annotator.annotate(frame.copy(), detections=detections)
-        
-        sv.process_video(
-            source_path=video_path,
-            target_path="structure_folder/video_tracked/result.mp4",
-            callback=callback
-        )
-        print("Video saved in <structure_folder/video_tracked/result.mp4>")
+        print(f"Detections saved in <{store_path}>" if columnar else f"CSV-File saved in <{csv_path}>")
+        print(f"Video saved in <{target_path}>")
+        for stage in ("decode", "inference", "encode"):
+            print(f"  {stage:<9} {report[stage]['fps']:>8} fps  utilization {report[stage]['utilization']}")
+        print(f"  end-to-end {report['end_to_end_fps']} fps")
+        if adaptive:
+            print(f"  gating    {report['gating']}")
         return "Done"
 
     def train(self, yaml_file_train):
@@ -102,6 +251,7 @@ class Model:
                 raise RuntimeError("Training failed")
             
             model.save(self.upgraded_model_path)
+            registry.invalidate(self.upgraded_model_path)
             print(f"Model saved in <{self.upgraded_model_path}>")
             return "Done"
             
@@ -112,19 +262,123 @@ class Model:
     def predict(self, img_path):
         """Predict objects in image"""
         try:
-            model = self._get_model()
-            return self._process_image(model, img_path)
+            return self._process_image(None, img_path, resolve_weights(self._weights_path()))
         except Exception as e:
             print(f"Prediction error: {e}")
             return ""
 
+    def detect(self, img_path, classes=None):
+        """Return the detections for an image without displaying them"""
+        try:
+            weights_path = self._weights_path() if classes else resolve_weights(self._weights_path())
+            image, mapped = self._load_image(img_path)
+            detections = self._detect(None, image, mapped, img_path, weights_path, classes)
+            # Boxes are in the pixels of the image the model saw, which may be a resized copy
+            detections.metadata["image_wh"] = (image.shape[1], image.shape[0])
+            return detections
+        except Exception as e:
+            print(f"Detection error: {e}")
+            return None
+
+    def detect_changes(self, img_path, survey, hashes, layout, classes=None):
+        """Re-infer only slices over tiles that changed since the site's last survey"""
+        try:
+            model = self._model_for(classes)
+            weights_path = self._weights_path() if classes else resolve_weights(self._weights_path())
+            image, mapped = self._load_image(img_path)
+            slicer = self._slicer(model, mapped, classes)
+            # Stored detections are only reused from the same weights and vocabulary
+            detector = {"weights": content_digest(weights_path), "classes": list(classes) if classes else None}
+            
+            changes = survey.compare(hashes, layout, detector)
+            previous = survey.previous_detections(image.shape) if changes["comparable"] else None
+            if previous is None:
+                detections = self._detect(model, image, mapped, img_path, weights_path, classes)
+                slices_inferred = slices_total = len(slicer.offsets((image.shape[1], image.shape[0])))
+            else:
+                # Tile rectangles are in mosaic pixels; non-mapped images were resized for the model
+                scale_x = image.shape[1] / (layout["cols"] * layout["tile_width"])
+                scale_y = image.shape[0] / (layout["rows"] * layout["tile_height"])
+                rects = [(x_min * scale_x, y_min * scale_y, x_max * scale_x, y_max * scale_y)
+                         for x_min, y_min, x_max, y_max in survey.changed_rects(changes, layout)]
+                detections, slices_inferred, slices_total = slicer.update(image, previous, rects)
+            
+            report = {
+                "site": survey.site,
+                "run_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "mode": "full" if previous is None else "incremental",
+                "cells": changes["cells"],
+                "changed": len(changes["changed"]),
+                "added": len(changes["added"]),
+                "removed": len(changes["removed"]),
+                "unchanged": changes["unchanged"],
+                "changed_cells": changes["changed"] + changes["added"] + changes["removed"],
+                "slices_total": slices_total,
+                "slices_inferred": slices_inferred,
+                "detections": len(detections)
+            }
+            survey.save(hashes, layout, image.shape, detections, report, detector)
+            detections.metadata["image_wh"] = (image.shape[1], image.shape[0])
+            return detections, report
+        except Exception as e:
+            print(f"Change detection error: {e}")
+            return None, None
+
+    def audit_prefilter(self, img_path, classes=None,
+                        report_path="structure_folder/CSV_folder/prefilter_audit.json"):
+        """Measure the slice pre-filter against unfiltered inference on one image"""
+        try:
+            if self.prefilter is None:
+                raise ValueError("No slice pre-filter configured")
+            
+            model = self._model_for(classes)
+            image, mapped = self._load_image(img_path)
+            infer = self._slice_infer(model, mapped)
+            
+            started = time.perf_counter()
+            baseline = BatchedSlicer(infer, batch_size=self.batch_size, merge=self.merge)(image)
+            baseline_s = time.perf_counter() - started
+            
+            started = time.perf_counter()
+            filtered = BatchedSlicer(infer, batch_size=self.batch_size, prefilter=self.prefilter,
+                                     merge=self.merge)(image)
+            filtered_s = time.perf_counter() - started
+            
+            # Baseline detections the filtered run lacks are the recall the filter gave up
+            comparison = compare_detections(baseline, filtered)
+            report = {
+                "image": img_path,
+                "slices": self.prefilter.checked,
+                "skipped": len(self.prefilter.skipped),
+                "skip_ratio": round(len(self.prefilter.skipped) / max(self.prefilter.checked, 1), 3),
+                "baseline_detections": len(baseline),
+                "filtered_detections": len(filtered),
+                "missed": comparison["missing"],
+                "recall": round(comparison["matched"] / len(baseline), 4) if len(baseline) else 1.0,
+                "baseline_s": round(baseline_s, 3),
+                "filtered_s": round(filtered_s, 3),
+                "speedup": round(baseline_s / filtered_s, 2) if filtered_s else 0.0,
+                "skipped_slices": self.prefilter.skipped
+            }
+            
+            with open(report_path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            print(f"Skipped {report['skipped']}/{report['slices']} slices, recall {report['recall']}, "
+                  f"speedup {report['speedup']}x")
+            print(f"Audit saved in <{report_path}>")
+            return report
+            
+        except Exception as e:
+            print(f"Pre-filter audit error: {e}")
+            return None
+
     def validation(self, yaml_file_val):
         """Validate the model"""
         try:
             if not yaml_file_val or not os.path.exists(yaml_file_val):
                 raise ValueError("Invalid YAML file path")
             
-            model = YOLO(self.upgraded_model_path if os.path.exists(self.upgraded_model_path) else self.base_model_path)
+            model = registry.get(self._weights_path(), YOLO)
             metrics = model.val(data=yaml_file_val, plots=True)
             print(metrics.confusion_matrix.to_df())
             return "Done"
@@ -133,14 +387,14 @@ class Model:
             print(f"Validation error: {e}")
             return ""
 
-    def track(self, video_path):
+    def track(self, video_path, adaptive=False, columnar=False):
         """Track objects in video"""
         try:
             if not video_path or not os.path.exists(video_path):
                 raise ValueError("Invalid video path")
             
-            model = YOLO(self.upgraded_model_path if os.path.exists(self.upgraded_model_path) else self.base_model_path)
-            return self._track_video(model, video_path)
+            model = self._get_inference_model(YOLO)
+            return self._track_video(model, video_path, adaptive, columnar)
             
         except Exception as e:
             print(f"Tracking error: {e}")
@@ -149,9 +403,7 @@ class Model:
     def define_custom_classes(self, img_path, order_class):
         """Define custom classes for detection"""
         try:
-            model = self._get_model()
-            model.set_classes(order_class)
-            return self._process_image(model, img_path)
+            return self._process_image(None, img_path, self._weights_path(), order_class)
             
         except Exception as e:
             print(f"Custom classes error: {e}")
@@ -160,8 +412,8 @@ class Model:
     def save_define_model(self, order_class):
         """Save model with custom classes"""
         try:
-            model = self._get_model()
-            model.set_classes(order_class)
+            # Saving needs the weights in this process, even when inference goes to a server
+            model = self._get_model(order_class, local=True)
             
             save_path = (self.upgraded_model_path.replace('.pt', '_Defined.pt') 
                         if os.path.exists(self.upgraded_model_path) 
@@ -173,4 +425,43 @@ class Model:
             
         except Exception as e:
             print(f"Save model error: {e}")
+            return ""
+
+    def export(self, fmt='openvino', int8=False, calibration_yaml=None):
+        """Export every available weight file to an optimized CPU runtime"""
+        try:
+            weights = [self.base_model_path, self.upgraded_model_path,
+                       self.base_model_path.replace('.pt', '_Defined.pt'),
+                       self.upgraded_model_path.replace('.pt', '_Defined.pt')]
+            weights = [path for path in weights if os.path.exists(path)]
+            if not weights:
+                raise ValueError("No model weights to export")
+            
+            for pt_path in weights:
+                exported = export_weights(pt_path, fmt=fmt, int8=int8, data=calibration_yaml)
+                print(f"Exported <{pt_path}> to <{exported}>")
+            return "Done"
+            
+        except Exception as e:
+            print(f"Export error: {e}")
+            return ""
+
+    def check_backend_parity(self, img_path, iou_threshold=0.5, confidence_tolerance=0.05):
+        """Compare detections of the exported backend with the PyTorch weights"""
+        try:
+            pt_path = self._weights_path()
+            exported_path = resolve_weights(pt_path)
+            if not is_exported(exported_path):
+                raise ValueError("No exported model newer than the .pt weights")
+            
+            image, mapped = self._load_image(img_path)
+            reference = self._detect(registry.get(pt_path, YOLOWorld), image, mapped)
+            candidate = self._detect(registry.get(exported_path, load_detect_backend), image, mapped)
+            
+            report = compare_detections(reference, candidate, iou_threshold, confidence_tolerance)
+            print(f"Backend parity <{exported_path}>: {report}")
+            return "Done" if report["passed"] else ""
+            
+        except Exception as e:
+            print(f"Parity check error: {e}")
             return ""
\ No newline at end of file
@@ -0,0 +1,119 @@
+import os
+import importlib.util
+import numpy as np
+import supervision as sv
+from ultralytics import YOLO
+
+
+# Suffixes ultralytics gives exported artifacts, most preferred first
+EXPORT_SUFFIXES = [
+    ('openvino', True, '_int8_openvino_model'),
+    ('openvino', False, '_openvino_model'),
+    ('onnx', False, '.onnx'),
+]
+
+# Optional packages each export format needs, for exporting and for running the artifact
+EXPORT_PACKAGES = {
+    'onnx': ['onnx', 'onnxruntime'],
+    'openvino': ['openvino'],
+}
+
+
+def _stem(pt_path):
+    """Strip the .pt extension the way ultralytics names exports"""
+    return pt_path[:-3] if pt_path.endswith('.pt') else pt_path
+
+
+def exported_paths(pt_path):
+    """List the artifacts an export of pt_path can produce, most preferred first"""
+    return [_stem(pt_path) + suffix for _, _, suffix in EXPORT_SUFFIXES]
+
+
+def resolve_weights(pt_path):
+    """Return the freshest exported CPU artifact for pt_path, or pt_path itself"""
+    if not os.path.exists(pt_path):
+        return pt_path
+
+    pt_mtime = os.path.getmtime(pt_path)
+    for path in exported_paths(pt_path):
+        # An export older than the .pt belongs to weights that were since retrained
+        if os.path.exists(path) and os.path.getmtime(path) > pt_mtime:
+            return path
+    return pt_path
+
+
+def is_exported(weights_path):
+    """Tell whether a weights path is an exported artifact rather than a .pt"""
+    return not weights_path.endswith('.pt')
+
+
+def load_detect_backend(weights_path):
+    """Load an exported detection model"""
+    return YOLO(weights_path, task='detect')
+
+
+def load_segment_backend(weights_path):
+    """Load an exported segmentation model"""
+    return YOLO(weights_path, task='segment')
+
+
+def export_weights(pt_path, fmt='openvino', int8=False, data=None, imgsz=640):
+    """Export .pt weights to ONNX Runtime or OpenVINO, optionally INT8-quantized"""
+    if fmt not in ('onnx', 'openvino'):
+        raise ValueError("Export format must be 'onnx' or 'openvino'")
+    if int8 and fmt != 'openvino':
+        raise ValueError("INT8 quantization is only available for the openvino format")
+    if int8 and (not data or not os.path.exists(data)):
+        raise ValueError("INT8 quantization needs a calibration dataset yaml")
+    if not os.path.exists(pt_path):
+        raise ValueError(f"Model weights not found: {pt_path}")
+    packages = EXPORT_PACKAGES[fmt] + (['nncf'] if int8 else [])
+    missing = [name for name in packages if importlib.util.find_spec(name) is None]
+    if missing:
+        raise ImportError(f"The {fmt} export needs: pip install {' '.join(missing)}")
+
+    options = {'format': fmt, 'imgsz': imgsz, 'dynamic': True}
+    if int8:
+        options.update(int8=True, data=data)
+
+    # Dynamic axes let the batched slicer send several slices per forward pass
+    return str(YOLO(pt_path).export(**options))
+
+
+def compare_detections(reference, candidate, iou_threshold=0.5, confidence_tolerance=0.05, mismatch_tolerance=0.02):
+    """Match two detection sets by class and IoU and report how far apart they are"""
+    matched = 0
+    max_confidence_delta = 0.0
+    ious = []
+    used = np.zeros(len(candidate), dtype=bool)
+
+    if len(reference) and len(candidate):
+        iou = sv.box_iou_batch(reference.xyxy, candidate.xyxy)
+        same_class = reference.class_id[:, None] == candidate.class_id[None, :]
+        iou = np.where(same_class, iou, 0.0)
+
+        for index in np.argsort(-reference.confidence):
+            scores = np.where(used, 0.0, iou[index])
+            best = int(np.argmax(scores))
+            if scores[best] < iou_threshold:
+                continue
+            used[best] = True
+            matched += 1
+            ious.append(float(scores[best]))
+            delta = abs(float(reference.confidence[index]) - float(candidate.confidence[best]))
+            max_confidence_delta = max(max_confidence_delta, delta)
+
+    missing = len(reference) - matched
+    extra = len(candidate) - matched
+    return {
+        "reference": len(reference),
+        "candidate": len(candidate),
+        "matched": matched,
+        "missing": missing,
+        "extra": extra,
+        "mean_iou": float(np.mean(ious)) if ious else 1.0,
+        "max_confidence_delta": max_confidence_delta,
+        # Quantized backends may flip a few detections that sit right on the confidence threshold
+        "passed": (missing + extra <= mismatch_tolerance * max(len(reference), 1)
+                   and max_confidence_delta <= confidence_tolerance)
+    }
@@ -0,0 +1,187 @@
+import numpy as np
+import supervision as sv
+from merging_Rdy import merge_detections
+
+
+def ultralytics_infer(model, **kwargs):
+    """Wrap an ultralytics model as a function from a list of images to detections"""
+    def infer(images):
+        results = model(images, **kwargs)
+        return [sv.Detections.from_ultralytics(result) for result in results]
+    return infer
+
+
+def _slice_record(detections):
+    """Serialize slice detections for a job journal; masks are too large and are not kept"""
+    record = {
+        "xyxy": detections.xyxy.tolist(),
+        "confidence": detections.confidence.tolist() if detections.confidence is not None else None,
+        "class_id": detections.class_id.tolist() if detections.class_id is not None else None
+    }
+    if "class_name" in detections.data:
+        record["class_name"] = [str(name) for name in detections.data["class_name"]]
+    return record
+
+
+def _slice_from_record(record):
+    """Rebuild slice detections written by _slice_record"""
+    if not record["xyxy"]:
+        return sv.Detections.empty()
+    detections = sv.Detections(
+        xyxy=np.array(record["xyxy"], dtype=np.float32),
+        confidence=np.array(record["confidence"], dtype=np.float32) if record["confidence"] is not None else None,
+        class_id=np.array(record["class_id"], dtype=int) if record["class_id"] is not None else None
+    )
+    if "class_name" in record:
+        detections.data["class_name"] = np.array(record["class_name"])
+    return detections
+
+
+class BatchedSlicer:
+    """Sliced inference that runs one forward pass per batch of slices"""
+
+    # Same slice grid as sv.InferenceSlicer(batch_size=...), but kept separate because its __call__
+    # runs every slice in one piece: resuming from a journal, the pre-filter, re-inferring only
+    # changed slices (update), sharding across processes and the grid merge all act per slice.
+    # Images resized to 640 px are a single slice, so batching only pays off on .npy mosaics
+
+    def __init__(self, infer, slice_wh=(640, 640), overlap_wh=(100, 100), iou_threshold=0.5, batch_size=8,
+                 prefilter=None, merge="nms"):
+        if overlap_wh[0] >= slice_wh[0] or overlap_wh[1] >= slice_wh[1]:
+            raise ValueError("Slice overlap must be smaller than the slice size")
+        self.infer = infer
+        self.slice_wh = slice_wh
+        self.overlap_wh = overlap_wh
+        self.iou_threshold = iou_threshold
+        # "nms", "soft-nms" or "wbf"; overlaps are found through a spatial grid, not all pairs
+        self.merge = merge
+        self.batch_size = max(1, int(batch_size))
+        # Optional SliceFilter: slices it rejects are never sent to the model
+        self.prefilter = prefilter
+
+    def _axis_starts(self, image_size, slice_size, stride):
+        """Slice start positions along one axis, with the last slice flush to the edge"""
+        if image_size <= slice_size:
+            return [0]
+        last_start = image_size - slice_size
+        starts = list(range(0, last_start, stride))
+        if not starts or starts[-1] != last_start:
+            starts.append(last_start)
+        return starts
+
+    def offsets(self, resolution_wh):
+        """Return (x_min, y_min, x_max, y_max) for every slice, row by row"""
+        width, height = resolution_wh
+        slice_width, slice_height = self.slice_wh
+        x_starts = self._axis_starts(width, slice_width, slice_width - self.overlap_wh[0])
+        y_starts = self._axis_starts(height, slice_height, slice_height - self.overlap_wh[1])
+        return [
+            (x, y, min(x + slice_width, width), min(y + slice_height, height))
+            for y in y_starts for x in x_starts
+        ]
+
+    def _batches(self, offsets):
+        """Group slice indices by slice shape so a batch is preprocessed like single calls"""
+        groups = {}
+        for index, (x_min, y_min, x_max, y_max) in enumerate(offsets):
+            groups.setdefault((x_max - x_min, y_max - y_min), []).append(index)
+
+        for indices in groups.values():
+            for start in range(0, len(indices), self.batch_size):
+                yield indices[start:start + self.batch_size]
+
+    def _read_slice(self, image, offset):
+        """Copy one slice out of the image; memory-mapped images read only this window"""
+        x_min, y_min, x_max, y_max = offset
+        return np.ascontiguousarray(image[y_min:y_max, x_min:x_max])
+
+    def _to_full_image(self, detections, offset, resolution_wh):
+        """Shift slice detections, and their masks, into full-image coordinates"""
+        x_min, y_min = offset[:2]
+        detections.xyxy = detections.xyxy + np.array([x_min, y_min, x_min, y_min], dtype=detections.xyxy.dtype)
+
+        if detections.mask is not None:
+            width, height = resolution_wh
+            slice_height, slice_width = detections.mask.shape[1:]
+            full_mask = np.zeros((len(detections), height, width), dtype=bool)
+            full_mask[:, y_min:y_min + slice_height, x_min:x_min + slice_width] = detections.mask
+            detections.mask = full_mask
+
+        # Per-slice metadata would conflict in Detections.merge
+        detections.metadata = {}
+        return detections
+
+    def _merge(self, detections_list):
+        """Merge per-slice detections and suppress duplicates from overlapping slices"""
+        merged = sv.Detections.merge(detections_list)
+        if len(merged) == 0:
+            return merged
+        return merge_detections(merged, self.merge, self.iou_threshold)
+
+    def run_slices(self, image, offsets, journal=None):
+        """Run inference on the given slices and return their detections in slice order"""
+        slice_detections = [None] * len(offsets)
+
+        pending = []
+        for index, offset in enumerate(offsets):
+            record = journal.get("slice", offset) if journal is not None else None
+            if record is not None:
+                # Inferred by an interrupted run with the same image, weights and slicing
+                slice_detections[index] = _slice_from_record(record)
+                journal.resumed += 1
+            else:
+                pending.append(index)
+
+        if self.prefilter is not None and pending:
+            keep = self.prefilter.keep(image, [offsets[index] for index in pending])
+            for index in np.array(pending)[~keep]:
+                slice_detections[index] = sv.Detections.empty()
+            pending = [index for index, kept in zip(pending, keep) if kept]
+
+        for index, detections in self._infer_slices(image, offsets, pending):
+            slice_detections[index] = detections
+            if journal is not None and detections.mask is None:
+                journal.record("slice", offsets[index], _slice_record(detections))
+
+        return slice_detections
+
+    def _infer_slices(self, image, offsets, indices):
+        """Yield (index, full-image detections) for the given slices, one batch at a time"""
+        resolution_wh = (image.shape[1], image.shape[0])
+        for batch in self._batches([offsets[index] for index in indices]):
+            batch_indices = [indices[i] for i in batch]
+            results = self.infer([self._read_slice(image, offsets[index]) for index in batch_indices])
+            for index, detections in zip(batch_indices, results):
+                yield index, self._to_full_image(detections, offsets[index], resolution_wh)
+
+    def _reset_prefilter(self):
+        """Start a new skip record for each whole image"""
+        if self.prefilter is not None:
+            self.prefilter.reset()
+
+    def __call__(self, image, journal=None):
+        self._reset_prefilter()
+        offsets = self.offsets((image.shape[1], image.shape[0]))
+        return self._merge(self.run_slices(image, offsets, journal))
+
+    def update(self, image, previous, changed_rects):
+        """Re-infer only slices overlapping changed rectangles and keep previous detections elsewhere"""
+        self._reset_prefilter()
+        offsets = self.offsets((image.shape[1], image.shape[0]))
+        dirty = [
+            offset for offset in offsets
+            if any(offset[0] < rect[2] and rect[0] < offset[2] and offset[1] < rect[3] and rect[1] < offset[3]
+                   for rect in changed_rects)
+        ]
+
+        # Previous boxes touching a changed area may be stale; the rest still match unchanged pixels.
+        # Boxes re-found by the dirty slices are merged away like any slice overlap
+        kept = []
+        if previous is not None and len(previous):
+            stale = np.zeros(len(previous), dtype=bool)
+            boxes = previous.xyxy
+            for x_min, y_min, x_max, y_max in changed_rects:
+                stale |= (boxes[:, 0] < x_max) & (x_min < boxes[:, 2]) & (boxes[:, 1] < y_max) & (y_min < boxes[:, 3])
+            kept.append(previous[~stale])
+
+        return self._merge(kept + self.run_slices(image, dirty)), len(dirty), len(offsets)
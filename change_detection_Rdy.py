@@ -0,0 +1,136 @@
+import csv
+import json
+import os
+import re
+import time
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+from result_cache_Rdy import encode_detections, decode_detections
+
+
+def dhash(tile, hash_size=16):
+    """Difference hash of a tile: signs of horizontal gradients on a small grayscale copy"""
+    gray = Image.fromarray(np.ascontiguousarray(tile)).convert('L')
+    small = np.asarray(gray.resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS), dtype=np.int16)
+    return np.packbits(small[:, 1:] > small[:, :-1]).tobytes().hex()
+
+
+def hamming(first, second):
+    """Number of differing bits between two hex hashes"""
+    return int(np.unpackbits(np.frombuffer(bytes.fromhex(first), dtype=np.uint8)
+                             ^ np.frombuffer(bytes.fromhex(second), dtype=np.uint8)).sum())
+
+
+class SiteSurvey:
+    """Tile hashes and detections of one site, kept between runs to find what changed"""
+
+    def __init__(self, site, survey_dir="structure_folder/surveys", max_distance=10, hash_size=16):
+        self.site = re.sub(r'[^A-Za-z0-9_-]+', '_', str(site)).strip('_') or "site"
+        self.site_dir = os.path.join(survey_dir, self.site)
+        self.state_path = os.path.join(self.site_dir, "state.json")
+        self.detections_path = os.path.join(self.site_dir, "detections.npz")
+        self.reports_path = os.path.join(self.site_dir, "reports.jsonl")
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        os.makedirs(self.site_dir, exist_ok=True)
+        self.state = self._load_state()
+
+    def _load_state(self):
+        """Load the previous run of this site, or None"""
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _load_tile(self, path, tiles):
+        """Take a tile from the downloader's arrays, or decode it from disk"""
+        if tiles and path in tiles:
+            return tiles[path]
+        try:
+            with Image.open(path) as image:
+                return np.array(image.convert('RGB'))
+        except (UnidentifiedImageError, IOError, OSError):
+            return None
+
+    def hash_tiles(self, csv_path, tiles=None):
+        """Hash every tile of a download and describe the grid the way Resolution lays it out"""
+        with open(csv_path, 'r', encoding='utf-8') as f:
+            rows = [row for row in csv.DictReader(f) if row.get('x', '').isdigit() and row.get('y', '').isdigit()]
+
+        hashes = {}
+        tile_shape = None
+        for row in sorted(rows, key=lambda row: (int(row['x']), int(row['y']))):
+            tile = self._load_tile(row['path_file'], tiles)
+            if tile is None:
+                continue
+            if tile_shape is None:
+                tile_shape = tile.shape[:2]
+            hashes[f"{row['x']}_{row['y']}"] = dhash(tile, self.hash_size)
+
+        if not hashes:
+            return hashes, None
+        xs = [int(cell.split('_')[0]) for cell in hashes]
+        ys = [int(cell.split('_')[1]) for cell in hashes]
+        # Each x is a mosaic row and each y a column, as in Resolution._build_mosaic
+        layout = {
+            "min_x": min(xs), "min_y": min(ys),
+            "rows": max(xs) - min(xs) + 1, "cols": max(ys) - min(ys) + 1,
+            "tile_height": tile_shape[0], "tile_width": tile_shape[1]
+        }
+        return hashes, layout
+
+    def compare(self, hashes, layout, detector=None):
+        """Classify cells as changed, added, removed or unchanged since the previous run"""
+        previous = self.state["hashes"] if self.state else {}
+        changed = [cell for cell in hashes
+                   if cell in previous and hamming(hashes[cell], previous[cell]) > self.max_distance]
+        added = [cell for cell in hashes if cell not in previous]
+        removed = [cell for cell in previous if cell not in hashes]
+        return {
+            "cells": len(hashes),
+            "changed": changed,
+            "added": added,
+            "removed": removed,
+            "unchanged": len(hashes) - len(changed) - len(added),
+            # A different grid means previous detections are in other coordinates, and other
+            # weights or classes mean they would not match what this run finds in unchanged areas
+            "comparable": bool(self.state) and self.state.get("layout") == layout
+                          and self.state.get("detector") == detector
+        }
+
+    def changed_rects(self, changes, layout):
+        """Mosaic pixel rectangles (x_min, y_min, x_max, y_max) of changed, added and removed cells"""
+        rects = []
+        for cell in changes["changed"] + changes["added"] + changes["removed"]:
+            x, y = (int(value) for value in cell.split('_'))
+            top = (x - layout["min_x"]) * layout["tile_height"]
+            left = (y - layout["min_y"]) * layout["tile_width"]
+            rects.append((left, top, left + layout["tile_width"], top + layout["tile_height"]))
+        return rects
+
+    def previous_detections(self, image_shape):
+        """Detections of the previous run, if they were made on an image of the same shape"""
+        if not self.state or self.state.get("image_shape") != list(image_shape[:2]):
+            return None
+        try:
+            with np.load(self.detections_path, allow_pickle=False) as data:
+                return decode_detections(data)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def save(self, hashes, layout, image_shape, detections, report, detector=None):
+        """Store this run as the baseline of the next one and append its change report"""
+        temp_path = f"{self.detections_path}.tmp.npz"
+        np.savez_compressed(temp_path, **encode_detections(detections))
+        os.replace(temp_path, self.detections_path)
+
+        self.state = {"hashes": hashes, "layout": layout, "image_shape": list(image_shape[:2]),
+                      "detector": detector, "updated": time.time()}
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.state_path)
+
+        with open(self.reports_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report) + "\n")
@@ -0,0 +1,360 @@
+import bisect
+import json
+import os
+import numpy as np
+import supervision as sv
+
+
+# One fixed-size record per detection; masks live in masks.bin as runs over the detection's box
+RECORD = np.dtype([
+    ("xyxy", np.float32, (4,)),
+    ("confidence", np.float32),
+    ("class_id", np.int32),
+    ("tracker_id", np.int32),
+    ("frame_index", np.int64),
+    ("mask_box", np.int32, (4,)),
+    ("mask_offset", np.int64),
+    ("mask_runs", np.int32),
+    ("mask_area", np.int64)
+])
+
+
+def encode_mask(mask, box):
+    """Run lengths of a mask cropped to its box, row-major, starting with a run of zeros"""
+    x_min, y_min, x_max, y_max = box
+    flat = np.ascontiguousarray(mask[y_min:y_max, x_min:x_max]).ravel()
+    if flat.size == 0:
+        return np.zeros(0, dtype=np.uint32)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat[0]:
+        runs = np.concatenate(([0], runs))
+    return runs.astype(np.uint32)
+
+
+def decode_mask(runs, box):
+    """Rebuild the box-sized boolean mask written by encode_mask"""
+    width, height = box[2] - box[0], box[3] - box[1]
+    values = np.arange(len(runs)) % 2 == 1
+    return np.repeat(values, runs.astype(np.int64)).reshape(height, width)
+
+
+def _mask_box(xyxy, mask_shape):
+    """Integer box around a detection, clipped to the mask, that its mask pixels are kept in"""
+    height, width = mask_shape
+    x_min, y_min = np.floor(xyxy[:2]).astype(int)
+    x_max, y_max = np.ceil(xyxy[2:]).astype(int) + 1
+    return [max(0, min(x_min, width)), max(0, min(y_min, height)),
+            max(0, min(x_max, width)), max(0, min(y_max, height))]
+
+
+class DetectionStore:
+    """Append-only columnar detections on disk: memory-mapped records plus run-length encoded masks"""
+
+    def __init__(self, path, mode="a", flush_rows=0):
+        if mode not in ("r", "a", "w"):
+            raise ValueError(f"Unknown store mode: {mode}")
+        self.path = path
+        self.mode = mode
+        # Rows held in memory before a write; 0 writes every append straight away
+        self.flush_rows = flush_rows
+        self._pending_records = []
+        self._pending_runs = []
+        self._pending_columns = {}
+        self._pending_rows = 0
+        self.records_path = os.path.join(path, "records.bin")
+        self.masks_path = os.path.join(path, "masks.bin")
+        self.meta_path = os.path.join(path, "meta.json")
+        self._records_file = None
+        self._masks_file = None
+        self._column_files = {}
+
+        if mode == "r":
+            if not os.path.exists(self.records_path):
+                raise ValueError(f"No detection store at {path}")
+        else:
+            os.makedirs(path, exist_ok=True)
+            if mode == "w":
+                for name in os.listdir(path):
+                    if name in ("records.bin", "masks.bin", "meta.json") or name.startswith("column_"):
+                        os.remove(os.path.join(path, name))
+        self.meta = self._load_meta()
+        if mode != "r":
+            if mode == "a":
+                self._drop_torn_writes()
+            # Records are written after the mask runs and column values they point to, so a crash
+            # leaves no dangling offsets
+            self._masks_file = open(self.masks_path, 'ab')
+            self._records_file = open(self.records_path, 'ab')
+            for name in self.meta["columns"]:
+                self._column_files[name] = open(self._column_path(name), 'ab')
+        # End of the mask stream in uint32 runs, counting runs still waiting to be flushed
+        self._mask_end = os.path.getsize(self.masks_path) // 4 if os.path.exists(self.masks_path) else 0
+        self._records = None
+        self._masks = None
+        self._columns = {}
+
+    def _column_path(self, name):
+        """Return the file holding one extra column"""
+        return os.path.join(self.path, f"column_{name}.bin")
+
+    def _drop_torn_writes(self):
+        """Cut a half-written last record or run left by a crash, so appends stay aligned"""
+        for file_path, unit in ((self.records_path, RECORD.itemsize), (self.masks_path, 4)):
+            if os.path.exists(file_path):
+                size = os.path.getsize(file_path)
+                if size % unit:
+                    os.truncate(file_path, size - size % unit)
+        # Column values written ahead of records that never made it are dropped as well
+        rows = os.path.getsize(self.records_path) // RECORD.itemsize if os.path.exists(self.records_path) else 0
+        for name, dtype in self.meta["columns"].items():
+            column_path = self._column_path(name)
+            if os.path.exists(column_path) and os.path.getsize(column_path) > rows * np.dtype(dtype).itemsize:
+                os.truncate(column_path, rows * np.dtype(dtype).itemsize)
+
+    def _load_meta(self):
+        """Read the store's class names and mask shape"""
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            meta = {"version": 1, "mask_shape": None, "class_names": {}, "last_frame": None, "frames_sorted": True}
+        # Extra per-row columns by name and dtype, e.g. the video pipeline's inferred flag
+        meta.setdefault("columns", {})
+        return meta
+
+    def _write_meta(self):
+        """Write meta.json, replacing it atomically"""
+        temp_path = f"{self.meta_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(temp_path, self.meta_path)
+
+    def set_info(self, **info):
+        """Record image-level details, such as the source image and its size, in meta.json"""
+        if self._records_file is None:
+            raise ValueError("Detection store is read-only")
+        self.meta.update(info)
+        self._write_meta()
+
+    def _add_column(self, name, dtype):
+        """Start an extra column, zero for the rows appended before it existed"""
+        dtype = np.dtype(dtype)
+        self.meta["columns"][name] = dtype.str
+        self._column_files[name] = open(self._column_path(name), 'wb')
+        self._column_files[name].write(np.zeros(len(self.records()), dtype=dtype).tobytes())
+        self._pending_columns[name] = [np.zeros(self._pending_rows, dtype=dtype)]
+
+    def append(self, detections, frame_index=0, **columns):
+        """Append detections, compressing each mask to runs over its box; returns the rows added
+
+        Keyword arguments are extra columns, one value for every row or one per row.
+        """
+        if self._records_file is None:
+            raise ValueError("Detection store is read-only")
+        count = len(detections)
+        if count == 0:
+            return 0
+
+        for name, value in columns.items():
+            if not name.isidentifier():
+                raise ValueError(f"Invalid column name: {name}")
+            value = np.asarray(value)
+            if name not in self.meta["columns"]:
+                self._add_column(name, value.dtype)
+            dtype = np.dtype(self.meta["columns"][name])
+            self._pending_columns.setdefault(name, []).append(np.broadcast_to(value, (count,)).astype(dtype))
+        for name, dtype in self.meta["columns"].items():
+            if name not in columns:
+                self._pending_columns.setdefault(name, []).append(np.zeros(count, dtype=np.dtype(dtype)))
+
+        records = np.zeros(count, dtype=RECORD)
+        records["xyxy"] = detections.xyxy
+        records["confidence"] = detections.confidence if detections.confidence is not None else 1.0
+        records["class_id"] = detections.class_id if detections.class_id is not None else -1
+        records["tracker_id"] = detections.tracker_id if detections.tracker_id is not None else -1
+        records["frame_index"] = frame_index
+        records["mask_runs"] = -1
+
+        if detections.mask is not None:
+            self.meta["mask_shape"] = list(detections.mask.shape[1:])
+            offset = self._mask_end
+            for row in range(count):
+                box = _mask_box(detections.xyxy[row], detections.mask.shape[1:])
+                runs = encode_mask(detections.mask[row], box)
+                self._pending_runs.append(runs)
+                records["mask_box"][row] = box
+                records["mask_offset"][row] = offset
+                records["mask_runs"][row] = len(runs)
+                # Odd runs are foreground, so the area is known without decoding
+                records["mask_area"][row] = int(runs[1::2].sum())
+                offset += len(runs)
+            self._mask_end = offset
+
+        if "class_name" in detections.data and detections.class_id is not None:
+            names = self.meta["class_names"]
+            for class_id, name in zip(detections.class_id, detections.data["class_name"]):
+                names.setdefault(str(int(class_id)), str(name))
+
+        # Frames appended in order let frame_rows binary-search the frame column
+        last_frame = self.meta.get("last_frame")
+        if last_frame is not None and frame_index < last_frame:
+            self.meta["frames_sorted"] = False
+        self.meta["last_frame"] = frame_index if last_frame is None else max(last_frame, frame_index)
+
+        self._pending_records.append(records)
+        self._pending_rows += count
+        if self._pending_rows >= self.flush_rows:
+            self.flush()
+        return count
+
+    def flush(self):
+        """Write buffered rows: mask runs first, then the records pointing at them, then meta.json"""
+        if self._records_file is None or not self._pending_records:
+            return
+        for runs in self._pending_runs:
+            self._masks_file.write(runs.tobytes())
+        self._masks_file.flush()
+        for name, values in self._pending_columns.items():
+            for chunk in values:
+                self._column_files[name].write(chunk.tobytes())
+            self._column_files[name].flush()
+        for records in self._pending_records:
+            self._records_file.write(records.tobytes())
+        self._records_file.flush()
+        self._write_meta()
+        self._pending_records, self._pending_runs, self._pending_rows = [], [], 0
+        self._pending_columns = {name: [] for name in self._pending_columns}
+        self._records = None
+        self._masks = None
+        self._columns = {}
+
+    def records(self):
+        """Memory-mapped structured array of every stored detection"""
+        if self._records is None:
+            size = os.path.getsize(self.records_path) if os.path.exists(self.records_path) else 0
+            # A partly written last record from an interrupted append is left out
+            count = size // RECORD.itemsize
+            self._records = np.memmap(self.records_path, dtype=RECORD, mode='r', shape=(count,)) \
+                if count else np.zeros(0, dtype=RECORD)
+        return self._records
+
+    def __len__(self):
+        return len(self.records())
+
+    def column(self, name):
+        """Memory-mapped values of one extra column, one per stored detection"""
+        if name not in self._columns:
+            dtype = np.dtype(self.meta["columns"][name])
+            column_path = self._column_path(name)
+            size = os.path.getsize(column_path) if os.path.exists(column_path) else 0
+            count = min(len(self.records()), size // dtype.itemsize)
+            self._columns[name] = np.memmap(column_path, dtype=dtype, mode='r', shape=(count,)) \
+                if count else np.zeros(0, dtype=dtype)
+        return self._columns[name]
+
+    def _mask_runs(self):
+        """Memory-mapped run-length stream of every mask"""
+        if self._masks is None:
+            size = os.path.getsize(self.masks_path) if os.path.exists(self.masks_path) else 0
+            self._masks = np.memmap(self.masks_path, dtype=np.uint32, mode='r', shape=(size // 4,)) \
+                if size >= 4 else np.zeros(0, dtype=np.uint32)
+        return self._masks
+
+    def mask(self, row, full=False):
+        """Decode one mask: box-sized by default, or placed on the full image"""
+        record = self.records()[row]
+        if record["mask_runs"] < 0:
+            return None
+        runs = self._mask_runs()[record["mask_offset"]:record["mask_offset"] + record["mask_runs"]]
+        crop = decode_mask(runs, record["mask_box"])
+        if not full:
+            return crop
+        x_min, y_min, x_max, y_max = record["mask_box"]
+        mask = np.zeros(self.meta["mask_shape"], dtype=bool)
+        mask[y_min:y_max, x_min:x_max] = crop
+        return mask
+
+    def query(self, class_id=None, min_confidence=None, bbox=None, frame_range=None, min_area=None):
+        """Row numbers matching every given filter, evaluated on the columns only"""
+        records = self.records()
+        selected = np.ones(len(records), dtype=bool)
+        if class_id is not None:
+            selected &= np.isin(records["class_id"], np.atleast_1d(class_id))
+        if min_confidence is not None:
+            selected &= records["confidence"] >= min_confidence
+        if bbox is not None:
+            xyxy = records["xyxy"]
+            selected &= (xyxy[:, 0] < bbox[2]) & (bbox[0] < xyxy[:, 2]) & (xyxy[:, 1] < bbox[3]) & (bbox[1] < xyxy[:, 3])
+        if frame_range is not None:
+            selected &= (records["frame_index"] >= frame_range[0]) & (records["frame_index"] < frame_range[1])
+        if min_area is not None:
+            selected &= records["mask_area"] >= min_area
+        return np.flatnonzero(selected)
+
+    def frame_rows(self, start, stop):
+        """Row numbers of frames start <= frame_index < stop, by binary search when frames were appended in order"""
+        frames = self.records()["frame_index"]
+        if self.meta.get("frames_sorted", True):
+            # bisect reads single elements; np.searchsorted would first copy the whole strided column
+            return np.arange(bisect.bisect_left(frames, start), bisect.bisect_left(frames, stop))
+        return np.flatnonzero((frames >= start) & (frames < stop))
+
+    def load_frames(self, start, stop, masks=False):
+        """Detections of a frame range, with a frame_index data column"""
+        rows = self.frame_rows(start, stop)
+        detections = self.load(rows, masks)
+        detections.data["frame_index"] = np.array(self.records()["frame_index"][rows], dtype=np.int64)
+        return detections
+
+    def load(self, rows=None, masks=False):
+        """Rebuild sv.Detections for some or all rows; full-size masks are decoded only on request"""
+        records = self.records()
+        if rows is not None:
+            records = records[rows]
+        if len(records) == 0:
+            return sv.Detections.empty()
+
+        detections = sv.Detections(
+            xyxy=np.array(records["xyxy"]),
+            confidence=np.array(records["confidence"]),
+            class_id=np.array(records["class_id"], dtype=int),
+            tracker_id=np.array(records["tracker_id"], dtype=int) if (records["tracker_id"] >= 0).any() else None
+        )
+        for name in self.meta["columns"]:
+            values = self.column(name)
+            detections.data[name] = np.array(values[rows] if rows is not None else values)
+        names = self.meta["class_names"]
+        if names:
+            detections.data["class_name"] = np.array([names.get(str(int(class_id)), "") for class_id in records["class_id"]])
+        if masks and self.meta["mask_shape"] and (records["mask_runs"] >= 0).all():
+            row_numbers = np.arange(len(self.records()))[rows] if rows is not None else range(len(records))
+            detections.mask = np.stack([self.mask(row, full=True) for row in row_numbers])
+        return detections
+
+    def stats(self):
+        """Return row count and on-disk size against the size of uncompressed masks"""
+        records = self.records()
+        mask_shape = self.meta["mask_shape"]
+        masked = int((records["mask_runs"] >= 0).sum()) if len(records) else 0
+        return {
+            "detections": len(records),
+            "records_bytes": os.path.getsize(self.records_path) if os.path.exists(self.records_path) else 0,
+            "masks_bytes": os.path.getsize(self.masks_path) if os.path.exists(self.masks_path) else 0,
+            "dense_masks_bytes": masked * mask_shape[0] * mask_shape[1] if mask_shape else 0
+        }
+
+    def close(self):
+        """Flush buffered rows and close the append handles"""
+        self.flush()
+        for handle in (self._records_file, self._masks_file, *self._column_files.values()):
+            if handle is not None:
+                handle.close()
+        self._records_file = self._masks_file = None
+        self._column_files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
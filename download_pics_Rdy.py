@@ -1,16 +1,58 @@
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 import re
 import csv
+import io
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
+import numpy as np
 from PIL import Image, UnidentifiedImageError
+from journal_Rdy import JobJournal
 
 
 class Download:
-    def __init__(self):
+    def __init__(self, workers=1, per_host_limit=4, cache=None, write_tiles=True, base_dir='download', resume=False,
+                 keep_journal=False, keep_tiles=True):
+        if resume and not write_tiles:
+            raise ValueError("Resuming downloads needs write_tiles=True")
+        if not write_tiles and not keep_tiles:
+            raise ValueError("Tiles must be written to disk or kept in memory")
         self.allowed_domains = ['picsfromspace.com', 'mt.google.com']
-        self.base_dir = 'download'
+        self.base_dir = base_dir
+        self.workers = max(1, int(workers))
+        self.per_host_limit = max(1, int(per_host_limit))
+        self.cache = cache
+        self.write_tiles = write_tiles
+        # Off when the consumer re-reads tiles from disk, so the decoded region is never held in RAM
+        self.keep_tiles = keep_tiles
+        self.resume = resume
+        # Leave a finished journal for the caller to complete once the later stages of its job succeed
+        self.keep_journal = keep_journal
+        self.journal = None
+        self.tiles = {}
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+        self.session = self._create_session()
+    
+    def _create_session(self):
+        """Create a keep-alive session shared by every tile request"""
+        session = requests.Session()
+        pool_size = max(self.workers, self.per_host_limit)
+        adapter = HTTPAdapter(pool_connections=len(self.allowed_domains), pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+    
+    def _host_slot(self, url):
+        """Return the semaphore limiting concurrent requests to the URL's host"""
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_slots[host]
     
     def _validate_url(self, url):
         """Validate URL to prevent SSRF attacks"""
@@ -31,6 +73,11 @@ class Download:
         filename = filename.replace('..', '_')
         return filename[:50]  # Limit length
     
+    def _tile_filename(self, safe_item, index, suffix='.png'):
+        """Tile file name cut to the length limit before the index and suffix, so tiles never share a name"""
+        tail = f"-{index}{suffix}"
+        return f"{safe_item[:max(1, 50 - len(tail))]}{tail}"
+    
     def _create_safe_path(self, subject, filename):
         """Create safe file path within allowed directory"""
         safe_subject = self._sanitize_filename(subject)
@@ -42,51 +89,93 @@ class Download:
         
         return os.path.join(dir_path, safe_filename)
     
+    def _decode_image(self, data):
+        """Decode image bytes without touching the disk"""
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return image
+    
+    def _encode_png(self, image):
+        """Encode an image as PNG bytes"""
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        return buffer.getvalue()
+    
+    def _keep_tile(self, file_path, image, encoded):
+        """Hand the tile array to the stitching stage and/or write it to disk"""
+        if self.keep_tiles:
+            self.tiles[file_path] = np.asarray(image.convert('RGB'))
+        if self.write_tiles:
+            with open(file_path, 'wb') as f:
+                f.write(encoded)
+        return True
+    
+    def _keep_cached_tile(self, data, file_path):
+        """Use cached, already resized tile bytes"""
+        image = self._decode_image(data) if self.keep_tiles else None
+        return self._keep_tile(file_path, image, data)
+    
     def _download_image(self, img_url, file_path):
         """Safely download and process image"""
         try:
             if not self._validate_url(img_url):
                 return False
-                
-            response = requests.get(img_url, timeout=10, stream=True)
+            
+            entry = self.cache.lookup(img_url) if self.cache is not None else None
+            if entry is not None and not self.cache.revalidate:
+                data = self.cache.get(img_url)
+                if data is not None:
+                    return self._keep_cached_tile(data, file_path)
+                entry = None
+            
+            request_headers = self.cache.conditional_headers(entry) if entry is not None else {}
+            
+            with self._host_slot(img_url):
+                response = self.session.get(img_url, headers=request_headers, timeout=10)
+            
+            if response.status_code == 304 and entry is not None:
+                data = self.cache.get(img_url, revalidated=True)
+                if data is not None:
+                    return self._keep_cached_tile(data, file_path)
+                # The cached blob disappeared; its entry is gone now, so fetch unconditionally
+                return self._download_image(img_url, file_path)
+            
             response.raise_for_status()
             
-            # Write image data
-            with open(file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            # Decode and resize straight from the response bytes
+            image = self._resize_image(self._decode_image(response.content))
+            encoded = self._encode_png(image) if self.write_tiles or self.cache is not None else None
             
-            # Process image
-            return self._resize_image(file_path)
+            if self.cache is not None:
+                self.cache.put(
+                    img_url, encoded,
+                    etag=response.headers.get('ETag'),
+                    last_modified=response.headers.get('Last-Modified'),
+                    source_size=len(response.content)
+                )
+            return self._keep_tile(file_path, image, encoded)
             
-        except (requests.RequestException, IOError) as e:
+        except requests.RequestException as e:
             print(f"Download failed: {e}")
             return False
-    
-    def _resize_image(self, file_path):
-        """Resize image with error handling"""
-        try:
-            with Image.open(file_path) as image:
-                target_size = 640
-                width, height = image.size
-                
-                if width > height:
-                    new_width = target_size
-                    new_height = int((target_size / width) * height)
-                else:
-                    new_height = target_size
-                    new_width = int((target_size / height) * width)
-                
-                resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                resized_image.save(file_path)
-                return True
-                
         except (UnidentifiedImageError, IOError, OSError) as e:
             print(f"Image processing failed: {e}")
-            if os.path.exists(file_path):
-                os.remove(file_path)
             return False
     
+    def _resize_image(self, image):
+        """Resize image in memory to the 640 px model input size"""
+        target_size = 640
+        width, height = image.size
+        
+        if width > height:
+            new_width = target_size
+            new_height = int((target_size / width) * height)
+        else:
+            new_height = target_size
+            new_width = int((target_size / height) * width)
+        
+        return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    
     def _extract_coordinates(self, url):
         """Extract coordinates from URL"""
         pattern = r'\d+'
@@ -103,10 +192,20 @@ class Download:
             csv_path = os.path.join(csv_dir, f"information_of_{safe_subject}.csv")
             
             fields = ["id", "subject", "path_file", "url_pic", "x", "y"]
+            buffer = io.StringIO(newline='')
+            writer = csv.DictWriter(buffer, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(pictures_info)
+            content = buffer.getvalue()
+            
+            # An identical manifest is left untouched, so a resumed run does not look like new data
+            if os.path.exists(csv_path):
+                with open(csv_path, 'r', newline='', encoding='utf-8') as csvfile:
+                    if csvfile.read() == content:
+                        return csv_path
+            
             with open(csv_path, 'w', newline='', encoding='utf-8') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fields)
-                writer.writeheader()
-                writer.writerows(pictures_info)
+                csvfile.write(content)
             
             return csv_path
             
@@ -114,59 +213,157 @@ class Download:
             print(f"CSV save failed: {e}")
             return ""
     
+    def _build_pic_info(self, pic_id, subject, file_path, img_src):
+        """Build one manifest row for a downloaded tile"""
+        x_coord, y_coord = self._extract_coordinates(img_src)
+        return {
+            "id": str(pic_id),
+            "subject": subject,
+            "path_file": file_path,
+            "url_pic": img_src,
+            "x": x_coord,
+            "y": y_coord
+        }
+    
+    def _download_sequential(self, tile_urls, safe_item):
+        """Download tiles one after another"""
+        pictures_info = []
+        downloaded_count = 0
+        
+        for img_src in tile_urls:
+            try:
+                # Create safe filename
+                filename = self._tile_filename(safe_item, downloaded_count)
+                file_path = self._create_safe_path(safe_item, filename)
+                
+                # Download and process image
+                if self._download_image(img_src, file_path):
+                    pictures_info.append(self._build_pic_info(downloaded_count, safe_item, file_path, img_src))
+                    downloaded_count += 1
+                    
+            except Exception as e:
+                print(f"Error processing image {downloaded_count}: {e}")
+                continue
+        
+        return pictures_info
+    
+    def _resume_tile(self, index, img_src, file_path):
+        """Reuse a tile a previous, interrupted run already downloaded"""
+        entry = self.journal.get("tile", index) if self.journal is not None else None
+        if not entry or entry["url"] != img_src or not os.path.exists(entry["path"]):
+            return False
+        if entry["path"] != file_path:
+            # The previous run already gave it its final name; renumbering starts over
+            os.replace(entry["path"], file_path)
+        if self.keep_tiles:
+            with Image.open(file_path) as image:
+                self.tiles[file_path] = np.asarray(image.convert('RGB'))
+        self.journal.resumed += 1
+        return True
+    
+    def _fetch_tile(self, index, img_src, safe_item):
+        """Download one tile to a temporary name for the concurrent path"""
+        try:
+            file_path = self._create_safe_path(safe_item, self._tile_filename(safe_item, index, ".part.png"))
+            if self._resume_tile(index, img_src, file_path):
+                return file_path
+            if self._download_image(img_src, file_path):
+                if self.journal is not None:
+                    self.journal.record("tile", index, {"url": img_src, "path": file_path})
+                return file_path
+        except Exception as e:
+            print(f"Error processing image {index}: {e}")
+        return None
+    
+    def _download_concurrent(self, tile_urls, safe_item):
+        """Download tiles on a worker pool, keeping the sequential manifest order"""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            temp_paths = list(executor.map(
+                lambda job: self._fetch_tile(job[0], job[1], safe_item),
+                enumerate(tile_urls)
+            ))
+        
+        # Number successful tiles in page order, exactly like the sequential loop
+        pictures_info = []
+        for index, (img_src, temp_path) in enumerate(zip(tile_urls, temp_paths)):
+            if temp_path is None:
+                continue
+            
+            pic_id = len(pictures_info)
+            file_path = self._create_safe_path(safe_item, self._tile_filename(safe_item, pic_id))
+            if self.keep_tiles:
+                self.tiles[file_path] = self.tiles.pop(temp_path)
+            if self.write_tiles:
+                os.replace(temp_path, file_path)
+            if self.journal is not None and self.journal.get("tile", index) != {"url": img_src, "path": file_path}:
+                self.journal.record("tile", index, {"url": img_src, "path": file_path})
+            pictures_info.append(self._build_pic_info(pic_id, safe_item, file_path, img_src))
+        
+        return pictures_info
+    
+    def _open_journal(self, create_url, safe_item):
+        """Open the journal of this exact download so a rerun continues where it stopped"""
+        return JobJournal({
+            "stage": "download",
+            "url": create_url,
+            "item": safe_item,
+            "base_dir": os.path.abspath(self.base_dir)
+        })
+    
+    def _list_tiles(self, create_url):
+        """Read the tile URLs from the satellite page, or from the journal of an interrupted run"""
+        if self.journal is not None and self.journal.done("page", create_url):
+            return self.journal.get("page", create_url)
+        
+        headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"}
+        response = self.session.get(create_url, headers=headers, timeout=10)
+        response.raise_for_status()
+        
+        soup = BeautifulSoup(response.text, 'html.parser')
+        tile_urls = [
+            img_tag.get('src', '') for img_tag in soup.find_all('img')
+            if img_tag.get('src', '').startswith("https://mt.google.com/vt/lyrs=y")
+        ]
+        if self.journal is not None and tile_urls:
+            self.journal.record("page", create_url, tile_urls)
+        return tile_urls
+    
     def req_and_get(self, create_url, item):
         """Main method to download satellite images"""
         if not create_url or not self._validate_url(create_url):
             raise ValueError("Invalid or unsafe URL provided")
         
         safe_item = self._sanitize_filename(item)
-        headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"}
+        self.tiles = {}
+        self.journal = self._open_journal(create_url, safe_item) if self.resume else None
         
         try:
-            # Get webpage content
-            response = requests.get(create_url, headers=headers, timeout=10)
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            img_tags = soup.find_all('img')
+            tile_urls = self._list_tiles(create_url)
             
-            pictures_info = []
-            downloaded_count = 0
+            # Journaled tiles sit at stable per-URL-index names until the final renumbering
+            if self.workers > 1 or self.journal is not None:
+                pictures_info = self._download_concurrent(tile_urls, safe_item)
+            else:
+                pictures_info = self._download_sequential(tile_urls, safe_item)
             
-            for img_tag in img_tags:
-                try:
-                    img_src = img_tag.get('src', '')
-                    if not img_src.startswith("https://mt.google.com/vt/lyrs=y"):
-                        continue
-                    
-                    # Create safe filename
-                    filename = f"{safe_item}-{downloaded_count}.png"
-                    file_path = self._create_safe_path(safe_item, filename)
-                    
-                    # Download and process image
-                    if self._download_image(img_src, file_path):
-                        x_coord, y_coord = self._extract_coordinates(img_src)
-                        
-                        pic_info = {
-                            "id": str(downloaded_count),
-                            "subject": safe_item,
-                            "path_file": file_path,
-                            "url_pic": img_src,
-                            "x": x_coord,
-                            "y": y_coord
-                        }
-                        pictures_info.append(pic_info)
-                        downloaded_count += 1
-                        
-                except Exception as e:
-                    print(f"Error processing image {downloaded_count}: {e}")
-                    continue
+            if self.cache is not None:
+                self.cache.flush()
+                cache_stats = self.cache.stats()
+                print(f"Tile cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                      f"{cache_stats['bytes_saved']} bytes saved")
             
             if not pictures_info:
                 return ""
             
             # Save to CSV
-            return self._save_to_csv(pictures_info, safe_item)
+            csv_path = self._save_to_csv(pictures_info, safe_item)
+            if self.journal is not None:
+                if self.journal.resumed:
+                    print(f"Resumed {self.journal.resumed} tiles from an interrupted run")
+                # Keep the journal while tiles are missing so a rerun fetches only those
+                if csv_path and len(pictures_info) == len(tile_urls) and not self.keep_journal:
+                    self.journal.complete()
+            return csv_path
             
         except requests.RequestException as e:
             print(f"Request failed: {e}")
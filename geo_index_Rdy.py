@@ -0,0 +1,226 @@
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = 111320.0
+
+
+def tile_grid(csv_path, default_tile_wh=(640, 640)):
+    """Describe the tile grid of a download: bounds, tile size in pixels and zoom level"""
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        rows = [row for row in csv.DictReader(f) if row.get('x', '').isdigit() and row.get('y', '').isdigit()]
+    if not rows:
+        raise ValueError("No tile coordinates in the CSV")
+
+    xs = [int(row['x']) for row in rows]
+    ys = [int(row['y']) for row in rows]
+    zooms = {match.group(1) for match in (re.search(r'[?&]z=(\d+)', row.get('url_pic', '')) for row in rows) if match}
+
+    tile_width, tile_height = default_tile_wh
+    for row in sorted(rows, key=lambda row: (int(row['x']), int(row['y']))):
+        try:
+            # Only the header is read; the mosaic uses the first tile's size for every slot
+            with Image.open(row['path_file']) as image:
+                tile_width, tile_height = image.size
+            break
+        except (UnidentifiedImageError, IOError, OSError):
+            continue
+
+    return {
+        "min_x": min(xs), "min_y": min(ys),
+        "rows": max(xs) - min(xs) + 1, "cols": max(ys) - min(ys) + 1,
+        "tile_height": tile_height, "tile_width": tile_width,
+        "zoom": int(zooms.pop()) if len(zooms) == 1 else None
+    }
+
+
+def pixels_to_lonlat(px, py, grid, bbox=None):
+    """Project mosaic pixel coordinates to longitude and latitude arrays"""
+    px = np.asarray(px, dtype=np.float64)
+    py = np.asarray(py, dtype=np.float64)
+    if grid.get("zoom") is None:
+        if bbox is None:
+            raise ValueError("Tiles carry no zoom level and no bounding box was given")
+        # Linear fallback over the (lon_min, lat_min, lon_max, lat_max) box of calculate_bounding_box
+        lon_min, lat_min, lon_max, lat_max = bbox
+        width = grid["cols"] * grid["tile_width"]
+        height = grid["rows"] * grid["tile_height"]
+        return lon_min + px / width * (lon_max - lon_min), lat_max - py / height * (lat_max - lat_min)
+
+    # Each x is a mosaic row and each y a column, as in Resolution._build_mosaic
+    row, row_offset = np.divmod(py, grid["tile_height"])
+    col, col_offset = np.divmod(px, grid["tile_width"])
+    tile_x = grid["min_x"] + row + col_offset / grid["tile_width"]
+    tile_y = grid["min_y"] + col + row_offset / grid["tile_height"]
+
+    # Web Mercator tile coordinates to degrees
+    scale = 2.0 ** grid["zoom"]
+    lon = tile_x / scale * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * tile_y / scale))))
+    return lon, lat
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters"""
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+class GeoIndex:
+    """Persistent SQLite R*Tree of georeferenced detections from every run"""
+
+    def __init__(self, db_path="structure_folder/geo_index.sqlite"):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._create_tables()
+
+    def _create_tables(self):
+        """Create the run, detection and R*Tree tables on first use"""
+        with self._lock, self._connection:
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id INTEGER PRIMARY KEY,
+                    site TEXT,
+                    image_path TEXT,
+                    created REAL,
+                    detections INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS detections (
+                    id INTEGER PRIMARY KEY,
+                    run_id INTEGER REFERENCES runs(run_id),
+                    site TEXT,
+                    class_name TEXT,
+                    confidence REAL,
+                    lat REAL,
+                    lon REAL
+                );
+                CREATE INDEX IF NOT EXISTS detections_class ON detections(class_name);
+                CREATE VIRTUAL TABLE IF NOT EXISTS detections_rtree USING rtree(
+                    id, min_lon, max_lon, min_lat, max_lat
+                );
+            """)
+
+    def add_detections(self, detections, grid, image_wh, site, image_path=None, bbox=None):
+        """Project detections from inference-image pixels to degrees and store them; returns the run id"""
+        mosaic_width = grid["cols"] * grid["tile_width"]
+        mosaic_height = grid["rows"] * grid["tile_height"]
+        # Detections may come from a resized copy of the mosaic
+        xyxy = detections.xyxy * np.array([mosaic_width / image_wh[0], mosaic_height / image_wh[1]] * 2)
+
+        center_lon, center_lat = pixels_to_lonlat((xyxy[:, 0] + xyxy[:, 2]) / 2, (xyxy[:, 1] + xyxy[:, 3]) / 2,
+                                                  grid, bbox)
+        corner_lon, corner_lat = pixels_to_lonlat(xyxy[:, [0, 2]], xyxy[:, [1, 3]], grid, bbox)
+
+        if "class_name" in detections.data:
+            names = [str(name) for name in detections.data["class_name"]]
+        elif detections.class_id is not None:
+            names = [str(class_id) for class_id in detections.class_id]
+        else:
+            names = [""] * len(detections)
+        confidence = detections.confidence if detections.confidence is not None else np.ones(len(detections))
+
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO runs (site, image_path, created, detections) VALUES (?, ?, ?, ?)",
+                (site, image_path, time.time(), len(detections)))
+            run_id = cursor.lastrowid
+            for index in range(len(detections)):
+                cursor = self._connection.execute(
+                    "INSERT INTO detections (run_id, site, class_name, confidence, lat, lon) VALUES (?, ?, ?, ?, ?, ?)",
+                    (run_id, site, names[index], float(confidence[index]),
+                     float(center_lat[index]), float(center_lon[index])))
+                self._connection.execute(
+                    "INSERT INTO detections_rtree (id, min_lon, max_lon, min_lat, max_lat) VALUES (?, ?, ?, ?, ?)",
+                    (cursor.lastrowid, float(corner_lon[index].min()), float(corner_lon[index].max()),
+                     float(corner_lat[index].min()), float(corner_lat[index].max())))
+        return run_id
+
+    def query_bbox(self, min_lat, min_lon, max_lat, max_lon, class_name=None, site=None):
+        """Detections whose box intersects a latitude/longitude rectangle"""
+        sql = """
+            SELECT d.id, d.run_id, d.site, d.class_name, d.confidence, d.lat, d.lon
+            FROM detections_rtree r JOIN detections d ON d.id = r.id
+            WHERE r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ?
+        """
+        params = [min_lon, max_lon, min_lat, max_lat]
+        if class_name is not None:
+            sql += " AND d.class_name = ?"
+            params.append(class_name)
+        if site is not None:
+            sql += " AND d.site = ?"
+            params.append(site)
+        with self._lock:
+            return [dict(row) for row in self._connection.execute(sql, params)]
+
+    def query_radius(self, lat, lon, radius_m, class_name=None, site=None):
+        """Detections centred within radius_m of a point, nearest first"""
+        # R*Tree pre-selection with a box that contains the circle, then the exact distance
+        delta_lat = radius_m / METERS_PER_DEGREE
+        delta_lon = radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        candidates = self.query_bbox(lat - delta_lat, lon - delta_lon, lat + delta_lat, lon + delta_lon,
+                                     class_name, site)
+        if not candidates:
+            return []
+
+        distances = haversine_m(lat, lon, np.array([row["lat"] for row in candidates]),
+                                np.array([row["lon"] for row in candidates]))
+        results = []
+        for row, distance in zip(candidates, distances):
+            if distance <= radius_m:
+                row["distance_m"] = round(float(distance), 2)
+                results.append(row)
+        return sorted(results, key=lambda row: row["distance_m"])
+
+    def stats(self):
+        """Return the number of indexed runs and detections"""
+        with self._lock:
+            runs = self._connection.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+            detections = self._connection.execute("SELECT COUNT(*) FROM detections").fetchone()[0]
+        return {"runs": runs, "detections": detections}
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query georeferenced detections from past runs")
+    parser.add_argument("--db", default="structure_folder/geo_index.sqlite", help="Index database")
+    parser.add_argument("--class-name", default=None, help="Only detections of this class")
+    parser.add_argument("--site", default=None, help="Only detections from this site / job id")
+    subparsers = parser.add_subparsers(dest="query", required=True)
+    radius = subparsers.add_parser("radius", help="Detections within a distance of a point")
+    radius.add_argument("lat", type=float)
+    radius.add_argument("lon", type=float)
+    radius.add_argument("meters", type=float)
+    bbox = subparsers.add_parser("bbox", help="Detections inside a latitude/longitude box")
+    for name in ("min_lat", "min_lon", "max_lat", "max_lon"):
+        bbox.add_argument(name, type=float)
+    args = parser.parse_args(argv)
+
+    index = GeoIndex(args.db)
+    if args.query == "radius":
+        results = index.query_radius(args.lat, args.lon, args.meters, args.class_name, args.site)
+    else:
+        results = index.query_bbox(args.min_lat, args.min_lon, args.max_lat, args.max_lon, args.class_name, args.site)
+    print(json.dumps(results, indent=2))
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
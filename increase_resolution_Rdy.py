@@ -1,13 +1,220 @@
 import csv
+import json
+import math
 import numpy as np
 import os
 from PIL import Image, UnidentifiedImageError
+from journal_Rdy import JobJournal
+from result_cache_Rdy import content_digest
+
+
+def open_mosaic(path):
+    """Open a mosaic saved as .npy read-only, without loading it into memory"""
+    return np.load(path, mmap_mode='r')
+
+
+def read_window(mosaic, x, y, width, height):
+    """Read one window of a mosaic array or .npy path, clipped to its bounds"""
+    if isinstance(mosaic, str):
+        mosaic = open_mosaic(mosaic)
+    return np.array(mosaic[max(0, y):y + height, max(0, x):x + width])
+
+
+def _pyramid_format(image_format):
+    """Normalise a tile format name to the PIL names the pyramid uses, 'PNG' or 'JPEG'"""
+    name = str(image_format).upper()
+    if name in ('JPG', 'JPEG'):
+        return 'JPEG'
+    if name == 'PNG':
+        return 'PNG'
+    raise ValueError(f"Unsupported pyramid tile format: {image_format}")
+
+
+def _pyramid_tile_path(path, level, row, col, image_format):
+    """Return the file holding one tile of one pyramid level"""
+    extension = 'jpg' if image_format == 'JPEG' else 'png'
+    return os.path.join(path, str(level), f"{row}_{col}.{extension}")
+
+
+def write_pyramid(canvas, path, tile_size=256, image_format='PNG', quality=90):
+    """Write a canvas as independently compressed tiles plus 2x overview levels"""
+    image_format = _pyramid_format(image_format)
+    height, width = canvas.shape[:2]
+    levels = []
+    level = 0
+    
+    while True:
+        rows = math.ceil(height / tile_size)
+        cols = math.ceil(width / tile_size)
+        os.makedirs(os.path.join(path, str(level)), exist_ok=True)
+        
+        for row in range(rows):
+            for col in range(cols):
+                if level == 0:
+                    top, left = row * tile_size, col * tile_size
+                    tile = Image.fromarray(np.ascontiguousarray(canvas[top:top + tile_size, left:left + tile_size]))
+                else:
+                    # Build each overview tile from the 2x2 finer tiles already on disk
+                    tile = _downsample_children(path, level - 1, row, col, levels[-1], image_format)
+                save_options = {'quality': quality} if image_format == 'JPEG' else {}
+                tile.save(_pyramid_tile_path(path, level, row, col, image_format), format=image_format, **save_options)
+        
+        levels.append({"level": level, "width": width, "height": height, "rows": rows, "cols": cols})
+        if rows == 1 and cols == 1:
+            break
+        
+        width = math.ceil(width / 2)
+        height = math.ceil(height / 2)
+        level += 1
+    
+    meta = {"tile_size": tile_size, "format": image_format, "levels": levels}
+    with open(os.path.join(path, "pyramid.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    return path
+
+
+def _downsample_children(path, child_level, row, col, child_info, image_format):
+    """Halve the up to 2x2 block of finer tiles covering one overview tile"""
+    row_strips = []
+    for child_row in (2 * row, 2 * row + 1):
+        if child_row >= child_info["rows"]:
+            continue
+        strip = []
+        for child_col in (2 * col, 2 * col + 1):
+            if child_col >= child_info["cols"]:
+                continue
+            with Image.open(_pyramid_tile_path(path, child_level, child_row, child_col, image_format)) as child:
+                strip.append(np.array(child.convert('RGB')))
+        row_strips.append(np.hstack(strip))
+    
+    block = Image.fromarray(np.vstack(row_strips))
+    width, height = block.size
+    return block.resize((math.ceil(width / 2), math.ceil(height / 2)), Image.Resampling.BOX)
+
+
+class Pyramid:
+    """Reader for tiled pyramids written by write_pyramid"""
+    
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "pyramid.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.tile_size = meta["tile_size"]
+        self.format = meta["format"]
+        self.levels = meta["levels"]
+    
+    def level_for(self, max_side):
+        """Return the finest level whose longest side fits in max_side"""
+        for info in self.levels:
+            if max(info["width"], info["height"]) <= max_side:
+                return info["level"]
+        return self.levels[-1]["level"]
+    
+    def read_window(self, x, y, width, height, level=0):
+        """Read a window of one level, decoding only the tiles it overlaps"""
+        info = self.levels[level]
+        x, y = max(0, x), max(0, y)
+        width = min(width, info["width"] - x)
+        height = min(height, info["height"] - y)
+        window = np.zeros((max(0, height), max(0, width), 3), dtype=np.uint8)
+        if width <= 0 or height <= 0:
+            return window
+        
+        size = self.tile_size
+        for row in range(y // size, (y + height - 1) // size + 1):
+            for col in range(x // size, (x + width - 1) // size + 1):
+                with Image.open(_pyramid_tile_path(self.path, level, row, col, self.format)) as tile_image:
+                    tile = np.array(tile_image.convert('RGB'))
+                
+                # Overlap of this tile with the window, in level coordinates
+                top, left = max(y, row * size), max(x, col * size)
+                bottom = min(y + height, row * size + tile.shape[0])
+                right = min(x + width, col * size + tile.shape[1])
+                window[top - y:bottom - y, left - x:right - x] = \
+                    tile[top - row * size:bottom - row * size, left - col * size:right - col * size]
+        
+        return window
+    
+    def read_level(self, level):
+        """Read a whole level, normally a small overview"""
+        info = self.levels[level]
+        return self.read_window(0, 0, info["width"], info["height"], level)
+
+
+class Mosaic:
+    """Preallocated canvas that tiles are written into slot by slot"""
+    
+    def __init__(self, rows, cols, tile_height, tile_width, channels=3, fill=0, path=None, reopen=False):
+        self.rows = rows
+        self.cols = cols
+        self.tile_height = tile_height
+        self.tile_width = tile_width
+        self.channels = channels
+        self.shape = (rows * tile_height, cols * tile_width, channels)
+        self.path = path
+        self.placed = 0
+        self.canvas = self._reopen() if reopen else None
+        self.reopened = self.canvas is not None
+        if self.canvas is None:
+            self.canvas = self._allocate(fill)
+    
+    def _reopen(self):
+        """Map an existing .npy canvas of the same shape so placed tiles are kept"""
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        try:
+            canvas = np.lib.format.open_memmap(self.path, mode='r+')
+        except (IOError, ValueError):
+            return None
+        return canvas if canvas.shape == self.shape and canvas.dtype == np.uint8 else None
+    
+    def _allocate(self, fill):
+        """Allocate the output canvas once, blank-filled for missing tiles"""
+        if self.path is None:
+            return np.full(self.shape, fill, dtype=np.uint8)
+        
+        # Out-of-core canvas: a .npy file mapped into memory, paged in by the OS
+        canvas = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.uint8, shape=self.shape)
+        if fill:
+            # A new file is zero-filled; fill one band of tiles at a time otherwise
+            for top in range(0, self.shape[0], self.tile_height):
+                canvas[top:top + self.tile_height] = fill
+        return canvas
+    
+    def place(self, row, col, tile):
+        """Copy one tile into its grid slot, cropping anything larger than the slot"""
+        if tile.ndim == 2:
+            tile = tile[:, :, np.newaxis]
+        
+        top = row * self.tile_height
+        left = col * self.tile_width
+        height = min(self.tile_height, tile.shape[0])
+        width = min(self.tile_width, tile.shape[1])
+        
+        self.canvas[top:top + height, left:left + width] = tile[:height, :width, :self.channels]
+        self.placed += 1
+    
+    def flush(self):
+        """Write pending pages of a memory-mapped canvas to disk"""
+        if isinstance(self.canvas, np.memmap):
+            self.canvas.flush()
 
 
 class Resolution:
-    def __init__(self):
-        self.image_rows = []
-        self.output_dir = "input_images"
+    def __init__(self, out_of_core=False, output_format='png', output_dir="input_images", resume=False,
+                 keep_journal=False):
+        self.mosaic = None
+        self.tiles = {}
+        # A finished output is reused in any format; only an out-of-core canvas keeps half-stitched regions
+        self.resume = resume
+        # Leave the journal for the caller to complete once the later stages of its job succeed
+        self.keep_journal = keep_journal
+        self.journal = None
+        self.reused = False
+        self.out_of_core = out_of_core
+        self.output_format = output_format
+        self.output_dir = output_dir
+        self.output_path = None
         os.makedirs(self.output_dir, exist_ok=True)
     
     def _validate_path(self, file_path):
@@ -30,6 +237,10 @@ class Resolution:
     
     def _load_image_safely(self, image_path):
         """Load image with proper error handling"""
+        if image_path in self.tiles:
+            # Tile already decoded in memory by the downloader
+            return self.tiles[image_path]
+        
         try:
             if not self._validate_path(image_path):
                 return None
@@ -39,90 +250,169 @@ class Resolution:
         except (UnidentifiedImageError, IOError, OSError):
             return None
     
-    def _organize_images_by_grid(self, data):
-        """Organize images into a grid structure"""
+    def _index_grid(self, data):
+        """Map (x, y) tile coordinates to image paths and return the grid bounds"""
         if not data:
-            return []
+            return {}, None
         
         # Extract coordinates and find bounds
         x_coords = [int(row['x']) for row in data if row.get('x', '').isdigit()]
         y_coords = [int(row['y']) for row in data if row.get('y', '').isdigit()]
         
         if not x_coords or not y_coords:
-            return []
+            return {}, None
         
-        min_x, max_x = min(x_coords), max(x_coords)
-        min_y, max_y = min(y_coords), max(y_coords)
+        bounds = (min(x_coords), max(x_coords), min(y_coords), max(y_coords))
         
         # Create grid structure
         grid = {}
         for row in data:
             try:
-                x = int(row['x'])
-                y = int(row['y'])
-                path = row['path_file']
-                
-                if x not in grid:
-                    grid[x] = {}
-                grid[x][y] = path
+                grid[(int(row['x']), int(row['y']))] = row['path_file']
             except (ValueError, KeyError):
                 continue
         
-        # Convert to ordered list of rows
-        image_rows = []
-        for x in range(min_x, max_x + 1):
-            if x in grid:
-                row_images = []
-                for y in range(min_y, max_y + 1):
-                    if y in grid[x]:
-                        img_array = self._load_image_safely(grid[x][y])
-                        if img_array is not None:
-                            row_images.append(img_array)
-                
-                if row_images:
-                    image_rows.append(row_images)
+        return grid, bounds
+    
+    def _create_mosaic(self, rows, cols, tile):
+        """Size the canvas from the grid and the first decoded tile"""
+        path = os.path.join(self.output_dir, "image.npy") if self.out_of_core else None
+        mosaic = Mosaic(rows, cols, tile.shape[0], tile.shape[1], path=path)
+        if self.journal is not None and self.out_of_core:
+            self.journal.record("canvas", path, {"rows": rows, "cols": cols,
+                                                 "tile_height": tile.shape[0], "tile_width": tile.shape[1]})
+        return mosaic
+    
+    def _resumed_mosaic(self, rows, cols):
+        """Reopen the canvas of an interrupted run so the regions it placed are kept"""
+        # Only an out-of-core canvas outlives the process
+        if self.journal is None or not self.out_of_core:
+            return None
         
-        return image_rows
+        path = os.path.join(self.output_dir, "image.npy")
+        canvas = self.journal.get("canvas", path)
+        if canvas and (canvas["rows"], canvas["cols"]) == (rows, cols):
+            mosaic = Mosaic(rows, cols, canvas["tile_height"], canvas["tile_width"], path=path, reopen=True)
+            if mosaic.reopened:
+                return mosaic
+        
+        # Nothing usable on disk, so whatever the journal says was placed is gone
+        self.journal.reset()
+        return None
+    
+    def _open_journal(self, csv_path):
+        """Open the journal of this exact stitch so a rerun continues where it stopped"""
+        # Keyed on the manifest's content: a rerun that rewrites the same CSV still resumes
+        return JobJournal({
+            "stage": "stitch",
+            "csv": os.path.abspath(csv_path),
+            "csv_digest": content_digest(csv_path),
+            "output_dir": os.path.abspath(self.output_dir),
+            "output_format": self.output_format,
+            "out_of_core": self.out_of_core
+        })
+    
+    def _reuse_output(self):
+        """Skip stitching when a previous run of this job already wrote the output"""
+        output_path = self.journal.get("output", self.output_format) if self.journal is not None else None
+        if not output_path or not os.path.exists(output_path):
+            return False
+        self.mosaic = None
+        self.output_path = output_path
+        self.reused = True
+        return True
     
-    def imgs_to_image(self, csv_path):
+    def _build_mosaic(self, grid, bounds):
+        """Decode tiles one at a time straight into their canvas slots"""
+        if bounds is None:
+            return None
+        
+        min_x, max_x, min_y, max_y = bounds
+        rows = max_x - min_x + 1
+        cols = max_y - min_y + 1
+        mosaic = self._resumed_mosaic(rows, cols)
+        
+        # Each x is a row of the output and each y a column, as in the manifest
+        for (x, y), path in sorted(grid.items()):
+            if mosaic is not None and mosaic.reopened and self.journal.done("region", f"{x}_{y}"):
+                # Already on the reopened canvas from the interrupted run
+                self.tiles.pop(path, None)
+                mosaic.placed += 1
+                continue
+            
+            tile = self._load_image_safely(path)
+            # Release the in-memory copy as soon as it is on the canvas
+            self.tiles.pop(path, None)
+            if tile is None:
+                continue
+            
+            if mosaic is None:
+                mosaic = self._create_mosaic(rows, cols, tile)
+            mosaic.place(x - min_x, y - min_y, tile)
+            if self.journal is not None and self.out_of_core:
+                # Mapped pages live in the OS page cache, so they survive the process dying
+                self.journal.record("region", f"{x}_{y}")
+        
+        return mosaic
+    
+    def imgs_to_image(self, csv_path, tiles=None):
         """Process CSV and organize images into grid structure"""
         try:
+            # Arrays Download already decoded, keyed by path_file, skip the disk read
+            self.tiles = tiles or {}
             data = self._load_csv_data(csv_path)
-            self.image_rows = self._organize_images_by_grid(data)
+            self.reused = False
+            self.journal = self._open_journal(csv_path) if self.resume else None
+            if self._reuse_output():
+                return
+            grid, bounds = self._index_grid(data)
+            self.mosaic = self._build_mosaic(grid, bounds)
             
-            if not self.image_rows:
+            if self.mosaic is None:
                 raise RuntimeError("No valid images found to process")
                 
         except Exception as e:
             raise RuntimeError(f"Image processing failed: {e}")
     
+    def _finish_output(self, output_path):
+        """Keep the written output's path; the journal is dropped unless the caller completes it later"""
+        self.output_path = output_path
+        if self.journal is None:
+            return
+        if self.keep_journal:
+            if self.journal.get("output", self.output_format) != output_path:
+                self.journal.record("output", self.output_format, output_path)
+        else:
+            self.journal.complete()
+            self.journal = None
+    
     def combined_img(self):
         """Combine images into single output image"""
         try:
-            if not self.image_rows:
+            if self.reused:
+                # Reused outputs still finish the journal, exactly like freshly written ones
+                self._finish_output(self.output_path)
+                return "saved all in one"
+            if self.mosaic is None:
                 raise RuntimeError("No image data available. Call imgs_to_image first.")
             
-            # Combine each row horizontally
-            combined_rows = []
-            for row_images in self.image_rows:
-                if row_images:
-                    try:
-                        combined_row = np.hstack(row_images)
-                        combined_rows.append(combined_row)
-                    except ValueError as e:
-                        print(f"Warning: Skipping row due to size mismatch: {e}")
-                        continue
-            
-            if not combined_rows:
-                raise RuntimeError("No rows could be combined")
+            if self.output_format == 'pyramid':
+                # Tiled pyramid instead of the flat PNG; works from in-memory and mapped canvases
+                self.mosaic.flush()
+                self._finish_output(write_pyramid(self.mosaic.canvas, os.path.join(self.output_dir, "image_pyramid")))
+                return "saved all in one"
             
-            # Combine all rows vertically
-            final_image = np.vstack(combined_rows)
+            if self.mosaic.path is not None:
+                # Out-of-core mosaics stay on disk as .npy; readers map windows of it
+                self.mosaic.flush()
+                self._finish_output(self.mosaic.path)
+                return "saved all in one"
             
             # Save the combined image
             output_path = os.path.join(self.output_dir, "image.png")
-            pil_image = Image.fromarray(final_image.astype('uint8'))
+            pil_image = Image.fromarray(self.mosaic.canvas)
             pil_image.save(output_path)
+            self._finish_output(output_path)
             
             return "saved all in one"
             
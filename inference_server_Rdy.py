@@ -0,0 +1,457 @@
+import argparse
+import http.client
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, urlencode, parse_qs
+import numpy as np
+from batched_slicer_Rdy import ultralytics_infer
+from result_cache_Rdy import encode_detections, decode_detections
+
+
+TASKS = ("detect", "segment")
+
+
+def _pack_images(images):
+    """Serialize a list of images into one uncompressed .npz body"""
+    buffer = io.BytesIO()
+    np.savez(buffer, **{f"image_{index}": np.ascontiguousarray(image) for index, image in enumerate(images)})
+    return buffer.getvalue()
+
+
+def _unpack_images(body):
+    """Read the images of a request body in their original order"""
+    with np.load(io.BytesIO(body), allow_pickle=False) as data:
+        return [data[f"image_{index}"] for index in range(len(data.files))]
+
+
+def _pack_detections(results):
+    """Serialize per-image detections into one .npz body; masks are bit-packed"""
+    arrays = {}
+    for index, detections in enumerate(results):
+        for name, array in encode_detections(detections).items():
+            arrays[f"{index}/{name}"] = array
+    buffer = io.BytesIO()
+    np.savez(buffer, count=np.array(len(results)), **arrays)
+    return buffer.getvalue()
+
+
+def _unpack_detections(body):
+    """Rebuild the per-image detections written by _pack_detections"""
+    with np.load(io.BytesIO(body), allow_pickle=False) as data:
+        grouped = [{} for _ in range(int(data["count"]))]
+        for key in data.files:
+            if key != "count":
+                index, name = key.split("/", 1)
+                grouped[int(index)][name] = data[key]
+    return [decode_detections(arrays) for arrays in grouped]
+
+
+def model_infer(model):
+    """Batch inference function of a local ultralytics model or a RemoteModel"""
+    if isinstance(model, RemoteModel):
+        return model.infer
+    return ultralytics_infer(model)
+
+
+class _Request:
+    """One client call waiting for its share of a batched forward pass"""
+
+    def __init__(self, images, task, classes):
+        self.images = images
+        self.key = (task, tuple(classes) if classes else None)
+        self.arrived = time.perf_counter()
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InferenceServer:
+    """Keeps the detection and segmentation models resident and batches concurrent requests"""
+
+    def __init__(self, max_batch=16, max_wait_ms=10.0, history=1000):
+        self.max_batch = max(1, int(max_batch))
+        # Latency budget: how long the first request of a batch may wait for others to join it
+        self.max_wait = max_wait_ms / 1000.0
+        self.started_at = time.time()
+        self._queue = queue.Queue()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._models = {}
+        self._lock = threading.Lock()
+        self._in_batch = 0
+        self._counters = dict.fromkeys(("requests", "images", "batches", "forward_passes", "errors"), 0)
+        self._latency = deque(maxlen=history)
+        self._queue_wait = deque(maxlen=history)
+        self._batch_images = deque(maxlen=history)
+
+    def _owner(self, task):
+        """Model wrapper that picks the weights of a task, created on first use"""
+        if task not in self._models:
+            # Imported here: Model_Rdy imports this module for the client side
+            if task == "detect":
+                from Model_Rdy import Model
+                self._models[task] = Model()
+            else:
+                from Model_InsSeg_Rdy import Model_InsSeg
+                self._models[task] = Model_InsSeg()
+        return self._models[task]
+
+    def _resolve(self, key):
+        """Return the resident model for a (task, classes) key; the registry keeps it loaded"""
+        task, classes = key
+        owner = self._owner(task)
+        if classes:
+            return owner._get_model(list(classes))
+        return owner._get_inference_model()
+
+    def preload(self, tasks=TASKS):
+        """Load and warm up models before the first request arrives"""
+        for task in tasks:
+            try:
+                self._resolve((task, None))
+                print(f"Loaded <{task}> model")
+            except Exception as e:
+                print(f"Could not load <{task}> model: {e}")
+
+    def submit(self, images, task="detect", classes=None):
+        """Queue images for inference and block until their detections are ready"""
+        if task not in TASKS:
+            raise ValueError(f"Unknown task: {task}")
+        request = _Request(list(images), task, classes)
+        if not request.images:
+            return []
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.results
+
+    def _collect(self):
+        """Take one request, then let others join until the batch is full or the budget is spent"""
+        try:
+            first = self._queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        pending = [first]
+        images = len(first.images)
+        deadline = first.arrived + self.max_wait
+        while images < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            pending.append(request)
+            images += len(request.images)
+        return pending
+
+    def _run_group(self, key, requests):
+        """Run the images of requests that share a model as same-shape forward passes of up to max_batch"""
+        images = [image for request in requests for image in request.images]
+        # Mixed shapes would be padded to a square instead of letterboxed, so each shape gets its
+        # own passes and a client's results do not depend on which requests it was batched with
+        shapes = {}
+        for index, image in enumerate(images):
+            shapes.setdefault(image.shape, []).append(index)
+        try:
+            infer = ultralytics_infer(self._resolve(key), verbose=False)
+            results = [None] * len(images)
+            passes = 0
+            for indices in shapes.values():
+                for start in range(0, len(indices), self.max_batch):
+                    chunk = indices[start:start + self.max_batch]
+                    for index, result in zip(chunk, infer([images[index] for index in chunk])):
+                        results[index] = result
+                    passes += 1
+        except Exception as e:
+            if len(requests) > 1:
+                # Retry each request on its own, so one bad image does not fail the ones batched with it
+                for request in requests:
+                    self._run_group(key, [request])
+                return
+            with self._lock:
+                self._counters["errors"] += 1
+            requests[0].error = str(e)
+            requests[0].done.set()
+            return
+
+        with self._lock:
+            self._counters["forward_passes"] += passes
+        offset = 0
+        for request in requests:
+            request.results = results[offset:offset + len(request.images)]
+            offset += len(request.images)
+            request.done.set()
+
+    def _batch_loop(self):
+        """Single model thread: every forward pass runs here, so models need no locking"""
+        while not self._stopping.is_set():
+            pending = self._collect()
+            if not pending:
+                continue
+
+            started = time.perf_counter()
+            with self._lock:
+                self._in_batch = len(pending)
+                self._counters["batches"] += 1
+                self._batch_images.append(sum(len(request.images) for request in pending))
+                self._queue_wait.extend(started - request.arrived for request in pending)
+
+            groups = {}
+            for request in pending:
+                groups.setdefault(request.key, []).append(request)
+            for key, requests in groups.items():
+                self._run_group(key, requests)
+
+            finished = time.perf_counter()
+            with self._lock:
+                self._in_batch = 0
+                self._counters["requests"] += len(pending)
+                self._counters["images"] += sum(len(request.images) for request in pending)
+                self._latency.extend(finished - request.arrived for request in pending)
+
+    def start(self):
+        """Start the batching thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._batch_loop, name="inference-batcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the batching thread after the current batch"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """Return queue depth, throughput counters and latency percentiles in milliseconds"""
+        def percentiles(values):
+            if not values:
+                return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+            values = np.array(values) * 1000
+            return {"p50": round(float(np.percentile(values, 50)), 2),
+                    "p95": round(float(np.percentile(values, 95)), 2),
+                    "max": round(float(values.max()), 2)}
+
+        from model_registry_Rdy import registry
+        with self._lock:
+            return {
+                "uptime_s": round(time.time() - self.started_at, 1),
+                "queue_depth": self._queue.qsize(),
+                "in_batch": self._in_batch,
+                "max_batch": self.max_batch,
+                "max_wait_ms": self.max_wait * 1000,
+                **self._counters,
+                "mean_batch_images": round(float(np.mean(self._batch_images)), 2) if self._batch_images else 0.0,
+                "latency_ms": percentiles(list(self._latency)),
+                "queue_wait_ms": percentiles(list(self._queue_wait)),
+                "models": registry.stats()
+            }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """HTTP front end: POST /infer, GET /stats and GET /health"""
+
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status, body, content_type="application/json"):
+        """Send a complete response; Content-Length keeps the connection reusable"""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/stats":
+            self._reply(200, json.dumps(self.server.inference.stats()).encode())
+        elif path == "/health":
+            self._reply(200, b'{"status": "ok"}')
+        else:
+            self._reply(404, b'{"error": "not found"}')
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if url.path != "/infer":
+            self._reply(404, b'{"error": "not found"}')
+            return
+
+        try:
+            query = parse_qs(url.query)
+            task = query.get("task", ["detect"])[0]
+            classes = json.loads(query["classes"][0]) if "classes" in query else None
+            if classes is not None and (not isinstance(classes, list)
+                                        or not all(isinstance(name, str) for name in classes)):
+                raise ValueError("classes must be a JSON list of class names")
+            images = _unpack_images(body)
+        except Exception as e:
+            # Malformed query or body: answer it rather than dropping the connection
+            self._reply(400, json.dumps({"error": f"Malformed request: {e}"}).encode())
+            return
+
+        try:
+            results = self.server.inference.submit(images, task, classes)
+        except (ValueError, KeyError) as e:
+            self._reply(400, json.dumps({"error": str(e)}).encode())
+            return
+        except RuntimeError as e:
+            self._reply(500, json.dumps({"error": str(e)}).encode())
+            return
+        self._reply(200, _pack_detections(results), "application/octet-stream")
+
+    def log_message(self, format, *args):
+        # Per-request logging would dominate the cost of small requests; /stats has the numbers
+        pass
+
+
+class _TCPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer with room for many clients connecting at once"""
+
+    request_queue_size = 128
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ThreadingHTTPServer equivalent on a Unix domain socket"""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(inference, host="127.0.0.1", port=8765, unix_socket=None):
+    """Serve an InferenceServer over HTTP until interrupted"""
+    if unix_socket:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(unix_socket)
+                raise RuntimeError(f"Another server is listening on {unix_socket}")
+            except (FileNotFoundError, ConnectionRefusedError):
+                pass
+        # A socket file left by a previous server would make bind fail
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        httpd = _UnixHTTPServer(unix_socket, _Handler)
+        address = f"unix://{unix_socket}"
+    else:
+        httpd = _TCPServer((host, port), _Handler)
+        address = f"http://{host}:{httpd.server_address[1]}"
+    httpd.inference = inference
+
+    inference.start()
+    print(f"Inference server listening on {address}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        inference.stop()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection over a Unix domain socket"""
+
+    def __init__(self, socket_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class InferenceClient:
+    """Client of a running inference server; one keep-alive connection per thread"""
+
+    def __init__(self, url="http://127.0.0.1:8765", timeout=300):
+        self.url = url
+        self.timeout = timeout
+        parts = urlsplit(url)
+        if parts.scheme == "unix":
+            self._connect = lambda: _UnixHTTPConnection(parts.path, timeout)
+        elif parts.scheme == "http":
+            self._connect = lambda: http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+        else:
+            raise ValueError(f"Unsupported inference server URL: {url}")
+        self._local = threading.local()
+
+    def _request(self, method, path, body=None):
+        """Send one request, reconnecting once if the server closed an idle connection"""
+        for attempt in range(2):
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                connection = self._local.connection = self._connect()
+            try:
+                connection.request(method, path, body=body)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, ConnectionError, BrokenPipeError):
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+                continue
+            if response.status != 200:
+                raise RuntimeError(f"Inference server error {response.status}: {data.decode(errors='replace')}")
+            return data
+
+    def infer(self, images, task="detect", classes=None):
+        """Return detections for a list of images, batched server-side with other callers"""
+        if not images:
+            return []
+        query = {"task": task}
+        if classes:
+            query["classes"] = json.dumps(list(classes))
+        return _unpack_detections(self._request("POST", f"/infer?{urlencode(query)}", _pack_images(images)))
+
+    def model(self, task="detect", classes=None):
+        """Return a handle used in place of a locally loaded model"""
+        return RemoteModel(self, task, classes)
+
+    def stats(self):
+        """Return the server's queue-depth and latency statistics"""
+        return json.loads(self._request("GET", "/stats"))
+
+
+class RemoteModel:
+    """Stands in for a loaded model; inference goes to the server"""
+
+    def __init__(self, client, task="detect", classes=None):
+        self.client = client
+        self.task = task
+        self.classes = list(classes) if classes else None
+
+    def infer(self, images):
+        """Batch inference with the same signature as ultralytics_infer"""
+        return self.client.infer(images, self.task, self.classes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve detection and segmentation models to local clients")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", default=None, help="Listen on a Unix domain socket instead of TCP")
+    parser.add_argument("--max-batch", type=int, default=16, help="Images per shared forward pass")
+    parser.add_argument("--max-wait-ms", type=float, default=10.0,
+                        help="Latency budget for gathering a batch")
+    parser.add_argument("--preload", nargs="*", default=list(TASKS), choices=TASKS,
+                        help="Models to load before accepting requests")
+    args = parser.parse_args(argv)
+
+    inference = InferenceServer(max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+    inference.preload(args.preload)
+    serve(inference, args.host, args.port, args.unix_socket)
+
+
+if __name__ == "__main__":
+    main()
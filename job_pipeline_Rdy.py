@@ -0,0 +1,125 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from increase_resolution_Rdy import Resolution
+
+
+def stitch_tiles(csv_path, output_dir, out_of_core=False, resume=False, keep_journal=False):
+    """Stitch the tiles listed in a download CSV; top level so a process pool can run it"""
+    resolution_step = Resolution(out_of_core=out_of_core, output_dir=output_dir, resume=resume,
+                                 keep_journal=keep_journal)
+    resolution_step.imgs_to_image(csv_path)
+    if resolution_step.combined_img() != "saved all in one":
+        raise RuntimeError("Failed to combine images")
+    return resolution_step.output_path
+
+
+def complete_stitch(csv_path, output_dir, out_of_core=False):
+    """Drop the journal stitch_tiles kept with keep_journal=True, once its whole job succeeded"""
+    Resolution(out_of_core=out_of_core, output_dir=output_dir, resume=True)._open_journal(csv_path).complete()
+
+
+def _timed_call(function, args):
+    """Run function(*args) and return the result with wall-clock start and end times"""
+    started = time.time()
+    result = function(*args)
+    return result, started, time.time()
+
+
+class JobPipeline:
+    """Overlap download, stitch and inference of many jobs, each stage on its own executor"""
+
+    STAGES = ("download", "stitch", "infer")
+
+    def __init__(self, download, infer, stitch=stitch_tiles, download_workers=4, stitch_workers=2, max_in_flight=8):
+        self.download = download
+        self.stitch = stitch
+        self.infer = infer
+        self.download_workers = max(1, int(download_workers))
+        self.stitch_workers = max(1, int(stitch_workers))
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    def _record(self, record, stage, started, finished):
+        """Keep a stage's start/end times on the job record and add them to the stage totals"""
+        record["timings"][stage] = round(finished - started, 3)
+        with self._lock:
+            self.stats[stage]["jobs"] += 1
+            self.stats[stage]["busy_s"] += finished - started
+
+    def _finish(self, record, done, slots, error=None):
+        """Close a job: keep its error, free its in-flight slot and resolve its future"""
+        if error is not None:
+            record["error"] = str(error)
+        with self._lock:
+            self._in_flight -= 1
+        slots.release()
+        done.set_result(record)
+
+    def _start(self, job, executors, slots):
+        """Submit a job's download; each finished stage submits the next one"""
+        download_pool, stitch_pool, model_worker = executors
+        record = {"job": job, "timings": {}, "error": None}
+        done = Future()
+
+        def after_infer(future):
+            try:
+                record["infer"], started, finished = future.result()
+                self._record(record, "infer", started, finished)
+                self._finish(record, done, slots)
+            except Exception as e:
+                self._finish(record, done, slots, e)
+
+        def after_stitch(future):
+            try:
+                record["stitch"], started, finished = future.result()
+                self._record(record, "stitch", started, finished)
+                # One model worker, so the model is only ever called from a single thread
+                model_worker.submit(_timed_call, self.infer, (job, record["stitch"])).add_done_callback(after_infer)
+            except Exception as e:
+                self._finish(record, done, slots, e)
+
+        def after_download(future):
+            try:
+                record["download"], started, finished = future.result()
+                self._record(record, "download", started, finished)
+                stitch_pool.submit(_timed_call, self.stitch, record["download"]).add_done_callback(after_stitch)
+            except Exception as e:
+                self._finish(record, done, slots, e)
+
+        with self._lock:
+            self._in_flight += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self._in_flight)
+        download_pool.submit(_timed_call, self.download, (job,)).add_done_callback(after_download)
+        return done
+
+    def run(self, jobs):
+        """Run every job through the three stages and return their records in job order"""
+        self.stats = {stage: {"jobs": 0, "busy_s": 0.0} for stage in self.STAGES}
+        self.stats["max_in_flight"] = 0
+        self._in_flight = 0
+        slots = threading.BoundedSemaphore(self.max_in_flight)
+
+        started = time.time()
+        # Spawned workers: forking while download threads hold locks can deadlock the child
+        with ThreadPoolExecutor(self.download_workers) as download_pool, \
+                ProcessPoolExecutor(self.stitch_workers, mp_context=multiprocessing.get_context("spawn")) as stitch_pool, \
+                ThreadPoolExecutor(1) as model_worker:
+            futures = []
+            for job in jobs:
+                # Blocks once max_in_flight jobs are between download start and inference end
+                slots.acquire()
+                futures.append(self._start(job, (download_pool, stitch_pool, model_worker), slots))
+            records = [future.result() for future in futures]
+        wall_time = time.time() - started
+
+        self.stats["wall_time_s"] = round(wall_time, 3)
+        for stage in self.STAGES:
+            self.stats[stage]["busy_s"] = round(self.stats[stage]["busy_s"], 3)
+        # Above 1.0 means stages of different jobs ran at the same time
+        busy = sum(self.stats[stage]["busy_s"] for stage in self.STAGES)
+        self.stats["overlap"] = round(busy / wall_time, 3) if wall_time else 0.0
+        return records
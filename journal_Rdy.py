@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import threading
+
+
+class JobJournal:
+    """Append-only JSON-lines record of finished work units, keyed by the job parameters"""
+
+    def __init__(self, params, journal_dir="structure_folder/journals"):
+        self.params = params
+        self.key = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        self.path = os.path.join(journal_dir, f"{self.key}.jsonl")
+        self.resumed = 0
+        self._lock = threading.Lock()
+        os.makedirs(journal_dir, exist_ok=True)
+        self._units = self._load()
+        if not os.path.exists(self.path):
+            self._append({"kind": "params", "unit": "", "data": params})
+
+    def _load(self):
+        """Read the units a previous run finished; a half-written last line is ignored"""
+        units = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The previous run died while writing this line
+                        continue
+                    units[(entry["kind"], str(entry["unit"]))] = entry.get("data")
+        except IOError:
+            pass
+        return units
+
+    def _append(self, entry):
+        """Write one line and push it to the OS so a crash right after keeps it"""
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+            f.flush()
+
+    def get(self, kind, unit):
+        """Return the data recorded for a finished unit, or None"""
+        with self._lock:
+            return self._units.get((kind, str(unit)))
+
+    def done(self, kind, unit):
+        """Tell whether a previous or the current run finished a unit"""
+        with self._lock:
+            return (kind, str(unit)) in self._units
+
+    def units(self, kind):
+        """Return {unit: data} for every finished unit of one kind"""
+        with self._lock:
+            return {unit: data for (entry_kind, unit), data in self._units.items() if entry_kind == kind}
+
+    def record(self, kind, unit, data=None):
+        """Mark a unit as finished"""
+        with self._lock:
+            self._units[(kind, str(unit))] = data
+            self._append({"kind": kind, "unit": str(unit), "data": data})
+
+    def reset(self):
+        """Forget every finished unit, e.g. when the output they were written to is gone"""
+        with self._lock:
+            self._units.clear()
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({"kind": "params", "unit": "", "data": self.params}, default=str) + "\n")
+
+    def complete(self):
+        """Drop the journal once the whole job succeeded, so a later run starts fresh"""
+        with self._lock:
+            self._units.clear()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -8,6 +8,7 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 try:
     from download_pics_Rdy import Download
+    from tile_cache_Rdy import TileCache
     from increase_resolution_Rdy import Resolution
 except ImportError as e:
     print(f"Import error: {e}")
@@ -82,7 +83,7 @@ def process_satellite_data(url, item):
     """Download and process satellite images"""
     try:
         print("Downloading satellite images...")
-        download_step = Download()
+        download_step = Download(cache=TileCache(revalidate=True))
         csv_path = download_step.req_and_get(url, item)
         
         if not csv_path:
@@ -90,13 +91,13 @@ def process_satellite_data(url, item):
         
         print("Processing and combining images...")
         resolution_step = Resolution()
-        resolution_step.imgs_to_image(csv_path)
+        resolution_step.imgs_to_image(csv_path, tiles=download_step.tiles)
         result = resolution_step.combined_img()
         
         if result != "saved all in one":
             raise RuntimeError("Failed to combine images")
             
-        return "input_images/image.png"
+        return resolution_step.output_path
         
     except Exception as e:
         raise RuntimeError(f"Satellite data processing failed: {e}")
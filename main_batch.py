@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import threading
+from collections import Counter
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    from download_pics_Rdy import Download
+    from tile_cache_Rdy import TileCache
+    from job_pipeline_Rdy import JobPipeline, complete_stitch
+    from change_detection_Rdy import SiteSurvey
+    from geo_index_Rdy import GeoIndex, tile_grid
+    from main_basic import calculate_bounding_box, create_satellite_url
+except ImportError as e:
+    print(f"Import error: {e}")
+    print("Please ensure all required files are in the same directory")
+    sys.exit(1)
+
+
+def _safe_id(text):
+    """Turn a job id or item into a directory name"""
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', str(text)).strip('_') or "job"
+
+
+def _validate_job(raw, index):
+    """Check one job record and return it with decimal coordinates"""
+    item = str(raw.get("item", "")).lower().strip()
+    if not item:
+        raise ValueError(f"Job {index}: missing item")
+    try:
+        lat = float(raw["lat"])
+        lon = float(raw["lon"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"Job {index}: lat and lon must be decimal degrees")
+    if not -90 <= lat <= 90:
+        raise ValueError(f"Job {index}: latitude must be between -90 and 90")
+    if not -180 <= lon <= 180:
+        raise ValueError(f"Job {index}: longitude must be between -180 and 180")
+
+    job_id = _safe_id(raw.get("id") or f"{index:04d}_{item}")
+    return {"id": job_id, "item": item, "lat": lat, "lon": lon}
+
+
+def load_jobs(jobs_path):
+    """Read (item, lat, lon) jobs from a CSV file or a JSON-lines file"""
+    if not os.path.exists(jobs_path):
+        raise ValueError(f"Jobs file not found: {jobs_path}")
+
+    with open(jobs_path, 'r', encoding='utf-8') as f:
+        if jobs_path.endswith(('.jsonl', '.json')):
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = list(csv.DictReader(f))
+
+    jobs = [_validate_job(record, index) for index, record in enumerate(records)]
+    ids = Counter(job["id"] for job in jobs)
+    duplicates = [job_id for job_id, count in ids.items() if count > 1]
+    if duplicates:
+        raise ValueError(f"Duplicate job ids: {', '.join(duplicates)}")
+    return jobs
+
+
+class BatchRunner:
+    """Run download, stitch and predict for many jobs, overlapping the stages of different jobs"""
+
+    def __init__(self, output_dir="batch_runs", download_jobs=4, stitch_jobs=2, max_in_flight=8,
+                 tile_workers=4, predict=True, item_as_class=False, out_of_core=False, resume=True,
+                 incremental=False, geo_index=None, server_url=None, shard_workers=0):
+        self.output_dir = output_dir
+        self.tile_workers = tile_workers
+        self.predict = predict
+        self.item_as_class = item_as_class
+        self.out_of_core = out_of_core
+        # Reruns after a failure continue from the journals of the interrupted jobs
+        self.resume = resume
+        # Re-infer only slices over tiles that changed since the previous survey of the same job id
+        self.incremental = incremental and predict
+        self._surveys = {}
+        # GeoIndex: detections of every run, projected to degrees for area queries
+        self.geo_index = geo_index if predict else None
+        self._csv_paths = {}
+        # Download journals of jobs still in flight; upstream journals outlive their stage until the job succeeds
+        self._download_journals = {}
+        self.cache = TileCache(revalidate=True)
+        self.model = None
+        # Registry models are shared and not thread-safe, so predict calls never overlap
+        self._model_lock = threading.Lock()
+        self.pipeline = JobPipeline(self._download, self._predict, download_workers=download_jobs,
+                                    stitch_workers=stitch_jobs, max_in_flight=max_in_flight)
+        if predict:
+            from Model_Rdy import Model
+            self.model = Model(resume=resume, server_url=server_url, shard_workers=shard_workers)
+
+    def _job_dir(self, job):
+        return os.path.join(self.output_dir, job["id"])
+
+    def _download(self, job):
+        """Download the tiles around the job coordinates and return the stitch arguments"""
+        job_dir = self._job_dir(job)
+        point1_x, point1_y, point2_x, point2_y = calculate_bounding_box(job["lon"], job["lat"])
+        # Coordinates are already signed decimals, so no sign prefix is needed
+        url = create_satellite_url("", point1_x, "", point1_y, point2_x, point2_y)
+        download_step = Download(workers=self.tile_workers, cache=self.cache,
+                                 base_dir=os.path.join(job_dir, "download"), resume=self.resume,
+                                 keep_journal=True, keep_tiles=False)
+        csv_path = download_step.req_and_get(url, job["item"])
+        if not csv_path:
+            raise RuntimeError("Failed to download satellite data")
+        self._csv_paths[job["id"]] = csv_path
+        self._download_journals[job["id"]] = download_step.journal
+        if self.incremental:
+            # Tiles are not kept in memory, so the survey hashes them from disk
+            survey = SiteSurvey(job["id"])
+            self._surveys[job["id"]] = (survey,) + survey.hash_tiles(csv_path)
+        # The stitch process reads tiles from disk too
+        return csv_path, os.path.join(job_dir, "image"), self.out_of_core, self.resume, self.resume
+
+    def _complete_journals(self, job, csv_path):
+        """Drop the download and stitch journals of a job that finished every stage"""
+        journal = self._download_journals.pop(job["id"], None)
+        if journal is not None:
+            journal.complete()
+        if self.resume and csv_path:
+            complete_stitch(csv_path, os.path.join(self._job_dir(job), "image"), self.out_of_core)
+
+    def _predict(self, job, img_path):
+        """Detect objects in the stitched image"""
+        if not self.predict:
+            self._complete_journals(job, self._csv_paths.pop(job["id"], None))
+            return {}
+
+        classes = [job["item"]] if self.item_as_class else None
+        changes = None
+        with self._model_lock:
+            if self.incremental:
+                survey, hashes, layout = self._surveys.pop(job["id"])
+                detections, changes = self.model.detect_changes(img_path, survey, hashes, layout, classes=classes)
+            else:
+                detections = self.model.detect(img_path, classes=classes)
+        if detections is None:
+            raise RuntimeError("Detection failed")
+
+        if "class_name" in detections.data:
+            labels = [str(name) for name in detections.data["class_name"]]
+        else:
+            labels = [str(class_id) for class_id in detections.class_id]
+        result = {"detections": len(detections), "class_counts": dict(Counter(labels))}
+        csv_path = self._csv_paths.pop(job["id"], None)
+        if self.geo_index is not None and csv_path:
+            bbox = calculate_bounding_box(job["lon"], job["lat"])
+            result["geo_run_id"] = self.geo_index.add_detections(
+                detections, tile_grid(csv_path), detections.metadata["image_wh"], job["id"], img_path, bbox)
+        if changes is not None:
+            result["changes"] = changes
+        self._complete_journals(job, csv_path)
+        return result
+
+    def _count_tiles(self, csv_path):
+        """Count the tiles listed in a download CSV"""
+        with open(csv_path, 'r', encoding='utf-8') as f:
+            return max(0, sum(1 for _ in f) - 1)
+
+    def _summarize(self, record):
+        """Turn a pipeline record into the job's summary entry"""
+        result = dict(record["job"], status="ok" if record["error"] is None else "failed",
+                      timings=record["timings"], tiles=0, image_path=record.get("stitch"))
+        if record.get("download"):
+            result["tiles"] = self._count_tiles(record["download"][0])
+        result.update(record.get("infer") or {})
+        if record["error"] is not None:
+            result["error"] = record["error"]
+        return result
+
+    def run(self, jobs):
+        """Run all jobs and return the summary"""
+        for job in jobs:
+            os.makedirs(self._job_dir(job), exist_ok=True)
+        try:
+            results = [self._summarize(record) for record in self.pipeline.run(jobs)]
+        finally:
+            if self.model is not None:
+                # Shard workers would otherwise live until the interpreter exits
+                self.model.close()
+
+        return {
+            "jobs": len(results),
+            "succeeded": sum(1 for result in results if result["status"] == "ok"),
+            "failed": sum(1 for result in results if result["status"] != "ok"),
+            "wall_time_s": self.pipeline.stats["wall_time_s"],
+            "pipeline": self.pipeline.stats,
+            "tile_cache": self.cache.stats(),
+            "results": results
+        }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Survey many coordinates without prompts")
+    parser.add_argument("jobs", help="CSV or JSON-lines file with item, lat, lon and an optional id per job")
+    parser.add_argument("--output-dir", default="batch_runs", help="Directory for per-job outputs")
+    parser.add_argument("--summary", default=None, help="Summary JSON path (default: <output-dir>/summary.json)")
+    parser.add_argument("--download-jobs", type=int, default=4, help="Jobs downloading at once")
+    parser.add_argument("--stitch-jobs", type=int, default=2, help="Jobs stitching at once")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="Jobs started but not yet finished")
+    parser.add_argument("--tile-workers", type=int, default=4, help="Concurrent tile downloads per job")
+    parser.add_argument("--no-predict", action="store_true", help="Only download and stitch")
+    parser.add_argument("--item-as-class", action="store_true", help="Use each job's item as the detection class")
+    parser.add_argument("--out-of-core", action="store_true", help="Stitch into memory-mapped .npy mosaics")
+    parser.add_argument("--fresh", action="store_true", help="Ignore journals of interrupted runs and start over")
+    parser.add_argument("--geo-index", default="structure_folder/geo_index.sqlite",
+                        help="SQLite index of georeferenced detections ('' to disable)")
+    parser.add_argument("--server-url", default=None,
+                        help="Send inference to a running inference_server_Rdy.py (http://host:port or unix:///path)")
+    parser.add_argument("--shard-workers", type=int, default=0,
+                        help="Split each mosaic's slices across this many model processes (with --out-of-core)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Re-infer only tiles that changed since the last run of each job id "
+                             "(needs --out-of-core: a PNG is resized to one 640 px slice)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        jobs = load_jobs(args.jobs)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 2
+
+    runner = BatchRunner(output_dir=args.output_dir, download_jobs=args.download_jobs,
+                         stitch_jobs=args.stitch_jobs, max_in_flight=args.max_in_flight,
+                         tile_workers=args.tile_workers, predict=not args.no_predict,
+                         item_as_class=args.item_as_class, out_of_core=args.out_of_core,
+                         resume=not args.fresh, incremental=args.incremental, server_url=args.server_url,
+                         shard_workers=args.shard_workers,
+                         geo_index=GeoIndex(args.geo_index) if args.geo_index else None)
+    summary = runner.run(jobs)
+
+    summary_path = args.summary or os.path.join(args.output_dir, "summary.json")
+    os.makedirs(os.path.dirname(summary_path) or ".", exist_ok=True)
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"{summary['succeeded']}/{summary['jobs']} jobs succeeded in {summary['wall_time_s']} s")
+    print(f"Summary saved in <{summary_path}>")
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
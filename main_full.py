@@ -7,9 +7,11 @@ import re
 import numpy as np
 import time
 from download_pics_Rdy import Download
+from tile_cache_Rdy import TileCache
 from increase_resolution_Rdy import Resolution
 from Model_Rdy import Model
 from Model_InsSeg_Rdy import Model_InsSeg
+from result_cache_Rdy import DetectionCache
 
 
 def display_text(text_content):
@@ -69,20 +71,20 @@ def create_satellite_url(long_sign, point1_x, lati_sign, point1_y, point2_x, poi
 def process_satellite_data(url, item):
     """Download and process satellite images"""
     try:
-        download_step = Download()
+        download_step = Download(cache=TileCache(revalidate=True))
         csv_path = download_step.req_and_get(url, item)
         
         if not csv_path:
             raise RuntimeError("Failed to download satellite data")
         
         resolution_step = Resolution()
-        resolution_step.imgs_to_image(csv_path)
+        resolution_step.imgs_to_image(csv_path, tiles=download_step.tiles)
         result = resolution_step.combined_img()
         
         if result != "saved all in one":
             raise RuntimeError("Failed to combine images")
             
-        return "input_images/image.png"
+        return resolution_step.output_path
         
     except Exception as e:
         raise RuntimeError(f"Satellite data processing failed: {e}")
@@ -96,6 +98,14 @@ def parse_custom_classes(input_text):
     return [input_text.strip()]
 
 
+def get_export_options():
+    """Ask for the runtime format and optional INT8 calibration data"""
+    fmt = input("Export format (openvino/onnx): ").strip().lower() or "openvino"
+    int8 = input("Quantize to INT8? (y/n): ").strip().lower().startswith('y')
+    calibration_yaml = input("Input path of yaml_file for <Calibration>: ").strip() if int8 else None
+    return fmt, int8, calibration_yaml
+
+
 def handle_object_detection(order, img_path, model):
     """Handle object detection operations"""
     try:
@@ -113,7 +123,9 @@ def handle_object_detection(order, img_path, model):
             
         elif order == "track-on-video":
             vid_path = input("Input path of Video for <Tracking>: ").strip()
-            result = model.track(vid_path)
+            adaptive = input("Skip unchanged frames? (y/n): ").strip().lower().startswith('y')
+            columnar = input("Write detections as a columnar store instead of CSV? (y/n): ").strip().lower().startswith('y')
+            result = model.track(vid_path, adaptive, columnar)
             
         elif order == "define-custom-classes":
             classes_input = input("Write classes (e.g., person car or person,car): ").lower().strip()
@@ -126,6 +138,11 @@ def handle_object_detection(order, img_path, model):
                     save_result = model.save_define_model(class_list)
                     if save_result != "Done":
                         raise RuntimeError("Model saving failed")
+            
+        elif order == "export":
+            result = model.export(*get_export_options())
+            if result == "Done" and input("Check detections against the .pt model? (y/n): ").strip().lower().startswith('y'):
+                result = model.check_backend_parity(img_path)
         
         if result != "Done":
             raise RuntimeError(f"Operation failed: {order}")
@@ -150,6 +167,9 @@ def handle_instance_segmentation(order, img_path, model):
             classes_input = input("Write classes (e.g., person car or person,car): ").lower().strip()
             class_list = parse_custom_classes(classes_input)
             result = model.define_custom_classes(class_list)
+            
+        elif order == "export":
+            result = model.export(*get_export_options())
         
         if result != "Done":
             raise RuntimeError(f"Operation failed: {order}")
@@ -162,17 +182,20 @@ def handle_instance_segmentation(order, img_path, model):
 
 def run_model_operations(img_path):
     """Handle model operations menu"""
-    work_options = ["train", "predict", "validation", "track-on-video", "define-custom-classes", "exit"]
+    work_options = ["train", "predict", "validation", "track-on-video", "define-custom-classes", "export", "exit"]
     task_options = ["objects-detection", "instance-segmentation", "exit"]
     
     # Initialize models
-    od_model = Model()
-    seg_model = Model_InsSeg()
+    result_cache = DetectionCache()
+    # Set INFERENCE_SERVER_URL to use models kept loaded by inference_server_Rdy.py
+    server_url = os.environ.get("INFERENCE_SERVER_URL") or None
+    od_model = Model(result_cache=result_cache, server_url=server_url)
+    seg_model = Model_InsSeg(result_cache=result_cache, server_url=server_url)
     
     while True:
         try:
             print("\nChoose operation:")
-            print("[ Train | Predict | Validation | Track-on-Video | Define-Custom-Classes | Exit ]")
+            print("[ Train | Predict | Validation | Track-on-Video | Define-Custom-Classes | Export | Exit ]")
             order = input("--> ").lower().strip()
             
             if order not in work_options:
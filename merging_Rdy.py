@@ -0,0 +1,257 @@
+import argparse
+import heapq
+import time
+import numpy as np
+import supervision as sv
+
+
+METHODS = ("nms", "soft-nms", "wbf")
+
+
+def _box_iou_pairs(xyxy, first, second):
+    """IoU of the boxes in each (first[k], second[k]) pair"""
+    a, b = xyxy[first], xyxy[second]
+    width = np.clip(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0, None)
+    height = np.clip(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0, None)
+    intersection = width * height
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return intersection / np.maximum(area_a + area_b - intersection, 1e-9)
+
+
+def _mask_iou_pairs(masks, xyxy, first, second):
+    """Mask IoU of each pair, counting pixels only where the two boxes overlap"""
+    areas = masks.reshape(len(masks), -1).sum(axis=1)
+    iou = np.zeros(len(first), dtype=np.float64)
+    for k, (i, j) in enumerate(zip(first, second)):
+        x_min, y_min = np.floor(np.maximum(np.maximum(xyxy[i, :2], xyxy[j, :2]), 0)).astype(int)
+        x_max, y_max = np.ceil(np.minimum(xyxy[i, 2:], xyxy[j, 2:])).astype(int) + 1
+        intersection = np.count_nonzero(masks[i, y_min:y_max, x_min:x_max] & masks[j, y_min:y_max, x_min:x_max])
+        iou[k] = intersection / max(areas[i] + areas[j] - intersection, 1)
+    return iou
+
+
+def candidate_pairs(xyxy, cell_size=None):
+    """Pairs of boxes that share a cell of a uniform grid; only these can overlap"""
+    count = len(xyxy)
+    if count < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if cell_size is None:
+        # About twice a typical box: most boxes fall in 1-4 cells and cells hold few boxes
+        sides = np.maximum(xyxy[:, 2] - xyxy[:, 0], xyxy[:, 3] - xyxy[:, 1])
+        cell_size = max(2.0 * float(np.median(sides)), 1.0)
+
+    origin = xyxy[:, :2].min(axis=0)
+    first_cell = np.floor((xyxy[:, :2] - origin) / cell_size).astype(np.int64)
+    last_cell = np.floor((xyxy[:, 2:] - origin) / cell_size).astype(np.int64)
+    spans = last_cell - first_cell + 1
+
+    # One (cell, box) entry for every cell a box touches
+    per_box = spans[:, 0] * spans[:, 1]
+    boxes = np.repeat(np.arange(count), per_box)
+    local = np.arange(len(boxes)) - np.repeat(np.cumsum(per_box) - per_box, per_box)
+    cell_x = first_cell[boxes, 0] + local % spans[boxes, 0]
+    cell_y = first_cell[boxes, 1] + local // spans[boxes, 0]
+    cells = cell_y * (int(last_cell[:, 0].max()) + 1) + cell_x
+
+    order = np.argsort(cells, kind="stable")
+    cells, boxes = cells[order], boxes[order]
+    first, second = [], []
+    for distance in range(1, len(cells)):
+        same = cells[distance:] == cells[:-distance]
+        if not same.any():
+            # Entries are sorted by cell, so no cell holds more than `distance` boxes
+            break
+        first.append(boxes[:-distance][same])
+        second.append(boxes[distance:][same])
+    if not first:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    first, second = np.concatenate(first), np.concatenate(second)
+
+    # Boxes sharing several cells show up once per shared cell
+    low, high = np.minimum(first, second), np.maximum(first, second)
+    unique = np.unique(low * count + high)
+    return unique // count, unique % count
+
+
+def overlap_graph(xyxy, class_id=None, min_iou=0.0, masks=None, cell_size=None):
+    """Sparse overlap graph in CSR form: neighbors of box i are neighbors[start[i]:start[i + 1]]"""
+    count = len(xyxy)
+    first, second = candidate_pairs(xyxy, cell_size)
+    if class_id is not None:
+        same_class = class_id[first] == class_id[second]
+        first, second = first[same_class], second[same_class]
+    iou = _box_iou_pairs(xyxy, first, second)
+    if masks is not None:
+        boxes_touch = iou > 0
+        first, second = first[boxes_touch], second[boxes_touch]
+        iou = _mask_iou_pairs(masks, xyxy, first, second)
+    # Strictly above the threshold, as in supervision's NMS
+    overlapping = iou > min_iou
+    first, second, iou = first[overlapping], second[overlapping], iou[overlapping]
+
+    source = np.concatenate([first, second])
+    order = np.argsort(source, kind="stable")
+    neighbors = np.concatenate([second, first])[order]
+    start = np.zeros(count + 1, dtype=np.int64)
+    start[1:] = np.cumsum(np.bincount(source, minlength=count))
+    return start, neighbors, np.concatenate([iou, iou])[order]
+
+
+def nms(xyxy, confidence, class_id=None, iou_threshold=0.5, masks=None):
+    """Greedy NMS over the overlap graph; same result as comparing every pair. Returns kept indices"""
+    start, neighbors, _ = overlap_graph(xyxy, class_id, iou_threshold, masks)
+    suppressed = np.zeros(len(xyxy), dtype=bool)
+    keep = []
+    # Same visiting order as supervision, so equal confidences resolve the same way
+    for index in confidence.argsort()[::-1]:
+        if suppressed[index]:
+            continue
+        keep.append(index)
+        suppressed[neighbors[start[index]:start[index + 1]]] = True
+    return np.array(keep, dtype=np.int64)
+
+
+def soft_nms(xyxy, confidence, class_id=None, sigma=0.5, score_threshold=0.001, masks=None):
+    """Gaussian soft-NMS: overlapping boxes lose confidence instead of being dropped; returns indices and scores"""
+    # A heap with lazy updates: decayed boxes are re-ranked only when they reach the top
+    start, neighbors, ious = overlap_graph(xyxy, class_id, 0.0, masks)
+    scores = confidence.astype(np.float64)
+    selected = np.zeros(len(xyxy), dtype=bool)
+    heap = [(-score, index) for index, score in enumerate(scores)]
+    heapq.heapify(heap)
+
+    keep, kept_scores = [], []
+    while heap:
+        negative_score, index = heapq.heappop(heap)
+        if -negative_score != scores[index]:
+            # Decayed since it was pushed: queue it again at its current score
+            if scores[index] >= score_threshold:
+                heapq.heappush(heap, (-scores[index], index))
+            continue
+        if scores[index] < score_threshold:
+            continue
+
+        selected[index] = True
+        keep.append(index)
+        kept_scores.append(scores[index])
+        span = slice(start[index], start[index + 1])
+        open_neighbors = ~selected[neighbors[span]]
+        targets = neighbors[span][open_neighbors]
+        scores[targets] *= np.exp(-(ious[span][open_neighbors] ** 2) / sigma)
+    return np.array(keep, dtype=np.int64), np.array(kept_scores, dtype=np.float32)
+
+
+def weighted_box_fusion(xyxy, confidence, class_id=None, iou_threshold=0.55, masks=None):
+    """Weighted box fusion: returns the leading index, fused box and mean confidence of every cluster"""
+    # Clusters form greedily around the most confident unassigned box
+    start, neighbors, _ = overlap_graph(xyxy, class_id, iou_threshold, masks)
+    cluster = np.full(len(xyxy), -1, dtype=np.int64)
+    leaders = []
+    for index in confidence.argsort()[::-1]:
+        if cluster[index] >= 0:
+            continue
+        cluster[index] = len(leaders)
+        leaders.append(index)
+        members = neighbors[start[index]:start[index + 1]]
+        cluster[members[cluster[members] < 0]] = cluster[index]
+
+    weights = confidence.astype(np.float64)
+    fused = np.zeros((len(leaders), 4), dtype=np.float64)
+    np.add.at(fused, cluster, xyxy * weights[:, None])
+    total = np.bincount(cluster, weights=weights, minlength=len(leaders))
+    sizes = np.bincount(cluster, minlength=len(leaders))
+    fused /= np.maximum(total, 1e-9)[:, None]
+    return np.array(leaders, dtype=np.int64), fused.astype(np.float32), (total / sizes).astype(np.float32)
+
+
+def merge_detections(detections, method="nms", iou_threshold=0.5, class_agnostic=False, sigma=0.5,
+                     score_threshold=0.001):
+    """Merge overlapping detections with grid-accelerated NMS, soft-NMS or weighted box fusion"""
+    if method not in METHODS:
+        raise ValueError(f"Unknown merge method: {method}")
+    if len(detections) == 0:
+        return detections
+
+    xyxy = detections.xyxy.astype(np.float64)
+    confidence = detections.confidence if detections.confidence is not None else np.ones(len(detections))
+    class_id = None if class_agnostic or detections.class_id is None else detections.class_id
+
+    if method == "nms":
+        # Like Detections.with_nms, masks are compared by mask IoU when present
+        return detections[np.sort(nms(xyxy, confidence, class_id, iou_threshold, detections.mask))]
+    if method == "soft-nms":
+        keep, scores = soft_nms(xyxy, confidence, class_id, sigma, score_threshold, detections.mask)
+        merged = detections[keep]
+        merged.confidence = scores
+        return merged
+
+    leaders, fused, scores = weighted_box_fusion(xyxy, confidence, class_id, iou_threshold, detections.mask)
+    # Class, name and mask come from the most confident box of each cluster
+    merged = detections[leaders]
+    merged.xyxy = fused
+    merged.confidence = scores
+    return merged
+
+
+def _synthetic_scene(count, seed=0, duplicates=4, classes=3, box_size=24.0, density=2e-4):
+    """Dense scene: objects at constant density, each detected by several overlapping slices"""
+    rng = np.random.default_rng(seed)
+    objects = max(1, count // duplicates)
+    side = np.sqrt(objects / density)
+    centers = rng.uniform(0, side, (objects, 2))
+    sizes = rng.uniform(0.6, 1.4, (objects, 1)) * box_size
+    object_class = rng.integers(0, classes, objects)
+
+    owner = np.repeat(np.arange(objects), duplicates)[:count]
+    jitter = rng.normal(0, 0.08, (len(owner), 4)) * sizes[owner]
+    xyxy = np.hstack([centers[owner] - sizes[owner] / 2, centers[owner] + sizes[owner] / 2]) + jitter
+    xyxy[:, 2:] = np.maximum(xyxy[:, 2:], xyxy[:, :2] + 1)
+    return sv.Detections(xyxy=xyxy.astype(np.float32),
+                         confidence=rng.uniform(0.2, 0.95, len(owner)).astype(np.float32),
+                         class_id=object_class[owner])
+
+
+def benchmark(sizes=(1000, 3000, 10000, 30000, 100000), baseline_limit=10000, repeats=3):
+    """Time every merge method against Detections.with_nms on growing synthetic scenes"""
+    rows = []
+    for count in sizes:
+        detections = _synthetic_scene(count)
+        row = {"detections": count}
+        for method in METHODS:
+            timings = []
+            for _ in range(repeats):
+                started = time.perf_counter()
+                merged = merge_detections(detections, method)
+                timings.append(time.perf_counter() - started)
+            row[method] = round(min(timings) * 1000, 1)
+            row[f"{method}_kept"] = len(merged)
+
+        if count <= baseline_limit:
+            # Global NMS builds a full count x count IoU matrix; beyond the limit it needs tens of GB
+            started = time.perf_counter()
+            reference = detections.with_nms(threshold=0.5)
+            row["with_nms"] = round((time.perf_counter() - started) * 1000, 1)
+            row["same_as_with_nms"] = row["nms_kept"] == len(reference) and np.allclose(
+                np.sort(merge_detections(detections, "nms").xyxy, axis=0), np.sort(reference.xyxy, axis=0))
+        rows.append(row)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark detection merging on dense synthetic scenes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 3000, 10000, 30000, 100000])
+    parser.add_argument("--baseline-limit", type=int, default=10000,
+                        help="Largest scene also merged with Detections.with_nms")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    rows = benchmark(args.sizes, args.baseline_limit, args.repeats)
+    print(f"{'detections':>10} {'nms ms':>9} {'soft-nms ms':>12} {'wbf ms':>9} {'with_nms ms':>12}  kept (nms)  same")
+    for row in rows:
+        print(f"{row['detections']:>10} {row['nms']:>9} {row['soft-nms']:>12} {row['wbf']:>9} "
+              f"{row.get('with_nms', '-'):>12}  {row['nms_kept']:>10}  {row.get('same_as_with_nms', '-')}")
+
+
+if __name__ == "__main__":
+    main()
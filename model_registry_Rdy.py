@@ -0,0 +1,91 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models keyed by weight path, mtime and task"""
+
+    def __init__(self, memory_budget=4 * 1024 ** 3):
+        self.memory_budget = memory_budget
+        self.loads = 0
+        self.hits = 0
+        self._models = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _key(self, weights_path, loader, variant):
+        """Build the cache key; a new mtime means new weights and a new entry"""
+        path = os.path.abspath(weights_path)
+        return (path, os.path.getmtime(weights_path), loader.__name__, variant)
+
+    def _estimate_size(self, model, weights_path):
+        """Estimate the resident size of a model from its parameters"""
+        try:
+            return sum(p.numel() * p.element_size() for p in model.model.parameters())
+        except (AttributeError, TypeError):
+            return os.path.getsize(weights_path)
+
+    def _warm_up(self, model):
+        """Run one dummy inference so the first real call skips lazy setup"""
+        try:
+            model(np.zeros((640, 640, 3), dtype=np.uint8), verbose=False)
+        except Exception as e:
+            print(f"Model warm-up skipped: {e}")
+
+    def _evict(self, keep):
+        """Drop least recently used models until the budget is met"""
+        total = sum(size for _, size in self._models.values())
+        for key in list(self._models):
+            if total <= self.memory_budget:
+                break
+            if key == keep:
+                continue
+            total -= self._models.pop(key)[1]
+
+    def get(self, weights_path, loader, variant=None, setup=None):
+        """Return a loaded, warmed-up model, loading it on first use"""
+        if not weights_path or not os.path.exists(weights_path):
+            raise ValueError(f"Model weights not found: {weights_path}")
+
+        key = self._key(weights_path, loader, variant)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return self._models[key][0]
+
+            model = loader(weights_path)
+            if setup is not None:
+                setup(model)
+            self._warm_up(model)
+
+            self.loads += 1
+            self._models[key] = (model, self._estimate_size(model, weights_path))
+            self._evict(keep=key)
+            return model
+
+    def invalidate(self, weights_path):
+        """Forget every cached model loaded from weights_path"""
+        path = os.path.abspath(weights_path)
+        with self._lock:
+            for key in [key for key in self._models if key[0] == path]:
+                del self._models[key]
+
+    def clear(self):
+        """Forget all cached models"""
+        with self._lock:
+            self._models.clear()
+
+    def stats(self):
+        """Return load/hit counters and the estimated resident size"""
+        with self._lock:
+            return {
+                "models": len(self._models),
+                "loads": self.loads,
+                "hits": self.hits,
+                "resident_bytes": sum(size for _, size in self._models.values())
+            }
+
+
+registry = ModelRegistry()
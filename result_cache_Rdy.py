@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import numpy as np
+import supervision as sv
+
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def _hash_file(digest, path):
+    """Feed one file into a running hash, 1 MB at a time"""
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+
+def content_digest(path):
+    """SHA-256 of a file, or of every file in a directory, memoized by path, mtime and size"""
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        files = [path]
+    # Re-hashing multi-GB weights or mosaics on every call would cost more than some inferences
+    stamp = tuple((name, os.path.getmtime(name), os.path.getsize(name)) for name in files)
+
+    with _digests_lock:
+        if _digests.get(path, (None,))[0] == stamp:
+            return _digests[path][1]
+
+    digest = hashlib.sha256()
+    for name in files:
+        digest.update(os.path.relpath(name, path).encode())
+        _hash_file(digest, name)
+    result = digest.hexdigest()
+
+    with _digests_lock:
+        _digests[path] = (stamp, result)
+    return result
+
+
+def encode_detections(detections):
+    """Turn detections into plain arrays for an .npz file; masks are bit-packed"""
+    arrays = {"xyxy": detections.xyxy.astype(np.float32)}
+    if detections.confidence is not None:
+        arrays["confidence"] = detections.confidence.astype(np.float32)
+    if detections.class_id is not None:
+        arrays["class_id"] = detections.class_id.astype(np.int64)
+    if "class_name" in detections.data:
+        arrays["class_name"] = np.asarray(detections.data["class_name"]).astype(str)
+    if detections.mask is not None:
+        arrays["mask_shape"] = np.array(detections.mask.shape, dtype=np.int64)
+        arrays["mask"] = np.packbits(detections.mask, axis=-1)
+    return arrays
+
+
+def decode_detections(data):
+    """Rebuild detections from arrays written by encode_detections"""
+    mask = None
+    if "mask" in data:
+        shape = tuple(data["mask_shape"])
+        mask = np.unpackbits(data["mask"], axis=-1, count=shape[-1]).astype(bool).reshape(shape)
+    detections = sv.Detections(
+        xyxy=data["xyxy"],
+        confidence=data["confidence"] if "confidence" in data else None,
+        class_id=data["class_id"].astype(int) if "class_id" in data else None,
+        mask=mask
+    )
+    if "class_name" in data:
+        detections.data["class_name"] = data["class_name"]
+    return detections
+
+
+class DetectionCache:
+    """On-disk LRU cache of sliced inference results keyed by image, weights, classes and slicing"""
+
+    def __init__(self, cache_dir="structure_folder/detection_cache", max_bytes=1024 ** 3):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._entries = self._load_index()
+
+    def _load_index(self):
+        """Load the index, dropping entries whose result file is gone"""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return {key: entry for key, entry in entries.items() if os.path.exists(self._result_path(key))}
+
+    def _result_path(self, key):
+        """Return the file holding one cached result"""
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def key(self, img_path, weights_path, classes, slicer, task="detect"):
+        """Build the cache key from everything that changes the detections"""
+        parts = {
+            "task": task,
+            "image": content_digest(img_path),
+            "weights": content_digest(weights_path),
+            "classes": list(classes) if classes else None,
+            "slice_wh": list(slicer.slice_wh),
+            "overlap_wh": list(slicer.overlap_wh),
+            "iou_threshold": slicer.iou_threshold,
+            "merge": slicer.merge,
+            "prefilter": slicer.prefilter.params() if slicer.prefilter is not None else None
+        }
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """Return cached detections and count a hit, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                with np.load(self._result_path(key), allow_pickle=False) as data:
+                    detections = decode_detections(data)
+            except (IOError, OSError, ValueError, KeyError):
+                # Result file vanished or is damaged; forget it so the image is inferred again
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            entry["last_used"] = time.time()
+            self.hits += 1
+            self._write_index()
+            return detections
+
+    def put(self, key, detections):
+        """Store detections for a key and evict old entries if over the cap"""
+        path = self._result_path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp.npz"
+        np.savez_compressed(temp_path, **encode_detections(detections))
+
+        with self._lock:
+            os.replace(temp_path, path)
+            self._entries[key] = {"size": os.path.getsize(path), "last_used": time.time()}
+            self._evict()
+            self._write_index()
+
+    def _evict(self):
+        """Drop least recently used results until the cache fits the size cap"""
+        total = sum(entry["size"] for entry in self._entries.values())
+        for key in sorted(self._entries, key=lambda k: self._entries[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= self._entries.pop(key)["size"]
+            try:
+                os.remove(self._result_path(key))
+            except OSError:
+                pass
+
+    def _write_index(self):
+        """Write the index to disk, replacing it atomically"""
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f)
+        os.replace(temp_path, self.index_path)
+
+    def stats(self):
+        """Return hit/miss counters and the current cache size"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "size_bytes": sum(entry["size"] for entry in self._entries.values())
+            }
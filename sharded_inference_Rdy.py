@@ -0,0 +1,123 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+from batched_slicer_Rdy import BatchedSlicer
+from result_cache_Rdy import encode_detections, decode_detections
+
+
+# Per-process state of a pool worker: the Model that owns the weights, created once by _init_worker
+_worker = {}
+
+
+def _init_worker(threads, batch_size):
+    """Pool initializer: limit intra-op threads and load the default model once per process"""
+    import torch
+    torch.set_num_threads(threads)
+    # Imported here: Model_Rdy imports this module
+    from Model_Rdy import Model
+    owner = Model(batch_size=batch_size)
+    owner._get_inference_model()
+    _worker["owner"] = owner
+
+
+def _attach(source):
+    """Map the parent's pixels: a shared-memory block or the mosaic's .npy file, never a copy"""
+    if source["kind"] == "memmap":
+        image = np.memmap(source["path"], dtype=source["dtype"], mode='r', offset=source["offset"],
+                          shape=source["shape"])
+        return image, None
+    # Spawned workers share the parent's resource tracker, so the parent's unlink is the only cleanup
+    block = shared_memory.SharedMemory(name=source["name"])
+    return np.ndarray(source["shape"], dtype=source["dtype"], buffer=block.buf), block
+
+
+def _infer_shard(source, offsets, classes, mapped):
+    """Worker task: run the slices of one shard and return their detections as arrays"""
+    image, block = _attach(source)
+    try:
+        owner = _worker["owner"]
+        model = owner._get_model(classes) if classes else owner._get_inference_model()
+        slicer = BatchedSlicer(owner._slice_infer(model, mapped), batch_size=owner.batch_size)
+        return [encode_detections(detections) for detections in slicer.run_slices(image, offsets)]
+    finally:
+        del image
+        if block is not None:
+            block.close()
+
+
+class ShardPool:
+    """Worker processes that each keep a detection model loaded between images"""
+
+    def __init__(self, workers=None, batch_size=8, shards_per_worker=2):
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self.batch_size = batch_size
+        # A few shards per worker so one slow region does not leave the other workers idle
+        self.shards_per_worker = max(1, int(shards_per_worker))
+        self._executor = None
+
+    def _pool(self):
+        """Start the workers on first use; spawn keeps torch and CUDA state out of the children"""
+        if self._executor is None:
+            threads = max(1, (os.cpu_count() or 1) // self.workers)
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker, initargs=(threads, self.batch_size))
+        return self._executor
+
+    def _shards(self, offsets):
+        """Split slices, kept in row-major order, into contiguous overlapping regions"""
+        count = min(len(offsets), self.workers * self.shards_per_worker)
+        return [list(indices) for indices in np.array_split(np.arange(len(offsets)), count)]
+
+    def _source(self, image):
+        """Describe where workers find the pixels, copying them into shared memory if needed"""
+        if isinstance(image, np.memmap) and image.filename and image.flags.c_contiguous \
+                and os.path.getsize(image.filename) == image.offset + image.nbytes:
+            # A whole .npy mosaic: workers map the same file and share the page cache
+            return {"kind": "memmap", "path": image.filename, "offset": image.offset,
+                    "dtype": image.dtype.str, "shape": image.shape}, None
+        block = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+        np.ndarray(image.shape, dtype=image.dtype, buffer=block.buf)[...] = image
+        return {"kind": "shared", "name": block.name, "dtype": image.dtype.str, "shape": image.shape}, block
+
+    def infer(self, image, offsets, classes=None, mapped=False):
+        """Run the given slices across the workers, yielding (position, detections) as shards finish"""
+        source, block = self._source(image)
+        try:
+            pool = self._pool()
+            futures = {pool.submit(_infer_shard, source, [offsets[index] for index in shard], classes, mapped): shard
+                       for shard in self._shards(offsets)}
+            for future in as_completed(futures):
+                for index, arrays in zip(futures[future], future.result()):
+                    yield index, decode_detections(arrays)
+        finally:
+            if block is not None:
+                block.close()
+                block.unlink()
+
+    def close(self):
+        """Stop the worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+class ShardedSlicer(BatchedSlicer):
+    """BatchedSlicer whose slices run in a ShardPool; resuming, pre-filtering and NMS stay in this process"""
+
+    def __init__(self, pool, classes=None, mapped=False, slice_wh=(640, 640), overlap_wh=(100, 100),
+                 iou_threshold=0.5, prefilter=None, merge="nms"):
+        super().__init__(None, slice_wh, overlap_wh, iou_threshold, pool.batch_size, prefilter, merge)
+        self.pool = pool
+        self.classes = list(classes) if classes else None
+        self.mapped = mapped
+
+    def _infer_slices(self, image, offsets, indices):
+        """Yield (index, full-image detections) for the given slices, inferred by the workers"""
+        if not indices:
+            return
+        for position, detections in self.pool.infer(image, [offsets[index] for index in indices],
+                                                    self.classes, self.mapped):
+            yield indices[position], detections
@@ -0,0 +1,64 @@
+import numpy as np
+
+
+class SliceFilter:
+    """Skip slices whose intensity spread and edge density say they are water, cloud or bare field"""
+
+    def __init__(self, min_std=6.0, min_edge_density=0.01, edge_threshold=12.0, sample_step=4):
+        self.min_std = min_std
+        self.min_edge_density = min_edge_density
+        self.edge_threshold = edge_threshold
+        self.sample_step = max(1, int(sample_step))
+        self.skipped = []
+        self.checked = 0
+
+    def params(self):
+        """Settings that change which slices are inferred, for cache and journal keys"""
+        return [self.min_std, self.min_edge_density, self.edge_threshold, self.sample_step]
+
+    def _slice_scores(self, image, offset):
+        """Intensity standard deviation and edge density of one slice, from every step-th pixel"""
+        step = self.sample_step
+        x_min, y_min, x_max, y_max = offset
+        # Samples sit on the image-wide step grid, plus one row and column before the slice so
+        # its first gradients match those of a whole-image pass
+        top, left = (y_min // step) * step, (x_min // step) * step
+        pad_y, pad_x = int(top > 0), int(left > 0)
+        sample = np.asarray(image[top - pad_y * step:y_max:step, left - pad_x * step:x_max:step], dtype=np.float32)
+        gray = sample.mean(axis=2) if sample.ndim == 3 else sample
+
+        edges = np.zeros(gray.shape, dtype=np.float32)
+        edges[:, 1:] = np.abs(np.diff(gray, axis=1))
+        edges[1:, :] = np.maximum(edges[1:, :], np.abs(np.diff(gray, axis=0)))
+
+        gray = gray[pad_y:, pad_x:].astype(np.float64)
+        if gray.size == 0:
+            return 0.0, 0.0
+        return float(gray.std()), float(np.mean(edges[pad_y:, pad_x:] > self.edge_threshold))
+
+    def scores(self, image, offsets):
+        """Return the intensity standard deviation and edge density of every slice"""
+        # One slice at a time: a mapped mosaic is only ever read a strided window at a time
+        scores = np.array([self._slice_scores(image, offset) for offset in offsets], dtype=np.float64)
+        return scores[:, 0], scores[:, 1]
+
+    def keep(self, image, offsets):
+        """Return a mask of slices worth inferring and record the ones that are skipped"""
+        if not offsets:
+            return np.zeros(0, dtype=bool)
+        std, edge_density = self.scores(image, offsets)
+        keep = (std >= self.min_std) & (edge_density >= self.min_edge_density)
+
+        self.checked += len(offsets)
+        for offset, slice_std, slice_edges in zip(np.array(offsets)[~keep], std[~keep], edge_density[~keep]):
+            self.skipped.append({
+                "offset": [int(value) for value in offset],
+                "std": round(float(slice_std), 3),
+                "edge_density": round(float(slice_edges), 5)
+            })
+        return keep
+
+    def reset(self):
+        """Forget the skipped slices of earlier images"""
+        self.skipped = []
+        self.checked = 0
@@ -0,0 +1,95 @@
+import os
+import threading
+import numpy as np
+import torch
+from ultralytics.nn.tasks import WorldModel, YOLOEModel
+
+
+class TextEmbeddingCache:
+    """Per-class YOLOWorld text embeddings kept in memory and in one .npz per text encoder"""
+
+    def __init__(self, cache_dir="structure_folder/text_embeddings", text_model="clip:ViT-B/32"):
+        self.cache_dir = cache_dir
+        # The encoder WorldModel.get_text_pe builds; only WorldModel vectors are cached
+        self.text_model = text_model
+        self.encoded = 0
+        self.hits = 0
+        self._vectors = {}
+        self._loaded = set()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _encoder(self, world_model):
+        """Name the encoder the vectors came from; other encoders get their own file"""
+        return f"{type(world_model).__name__}-{self.text_model}".replace(':', '-').replace('/', '-')
+
+    def _path(self, encoder):
+        """Return the file holding every cached vector of one encoder"""
+        return os.path.join(self.cache_dir, f"{encoder}.npz")
+
+    def _load(self, encoder):
+        """Read an encoder's vectors from disk the first time that encoder is used"""
+        if encoder in self._loaded:
+            return
+        self._loaded.add(encoder)
+        try:
+            with np.load(self._path(encoder), allow_pickle=False) as data:
+                for name, vector in zip(data["names"], data["vectors"]):
+                    self._vectors.setdefault((encoder, str(name)), vector)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def _save(self, encoder):
+        """Write an encoder's vectors, replacing the file atomically"""
+        names = [name for key_encoder, name in self._vectors if key_encoder == encoder]
+        vectors = np.stack([self._vectors[(encoder, name)] for name in names])
+        temp_path = f"{self._path(encoder)}.tmp.npz"
+        np.savez(temp_path, names=np.array(names), vectors=vectors)
+        os.replace(temp_path, self._path(encoder))
+
+    def embeddings(self, model, classes):
+        """Return the (1, classes, dim) text features, encoding only class names not seen before"""
+        world_model = model.model
+        encoder = self._encoder(world_model)
+        with self._lock:
+            self._load(encoder)
+            missing = [name for name in dict.fromkeys(classes) if (encoder, name) not in self._vectors]
+            self.hits += len(classes) - len(missing)
+            if missing:
+                # Each class name is encoded on its own, so vectors can be combined in any order
+                features = world_model.get_text_pe(missing).reshape(len(missing), -1)
+                for name, vector in zip(missing, features.cpu().float().numpy()):
+                    self._vectors[(encoder, name)] = vector
+                self.encoded += len(missing)
+                self._save(encoder)
+            stacked = np.stack([self._vectors[(encoder, name)] for name in classes])
+
+        device = next(world_model.parameters()).device
+        return torch.from_numpy(stacked)[None].to(device)
+
+    def set_classes(self, model, classes):
+        """Drop-in for YOLOWorld.set_classes that reuses cached text embeddings"""
+        classes = list(classes)
+        world_model = model.model
+        if isinstance(world_model, YOLOEModel):
+            # YOLOE reads pe, not txt_feats, and runs names through its own prompt head, so its
+            # vectors belong to the weights rather than the text encoder and are not cached
+            world_model.set_classes(classes, world_model.get_text_pe(classes))
+            model.predictor = None
+            return
+        if not isinstance(world_model, WorldModel):
+            model.set_classes(classes)
+            return
+
+        world_model.txt_feats = self.embeddings(model, classes)
+        world_model.model[-1].nc = len(classes)
+        world_model.names = classes
+        model.predictor = None
+
+    def stats(self):
+        """Return how many class names were encoded and how many came from the cache"""
+        with self._lock:
+            return {"encoded": self.encoded, "hits": self.hits, "vectors": len(self._vectors)}
+
+
+text_embeddings = TextEmbeddingCache()
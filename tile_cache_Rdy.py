@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+
+class TileCache:
+    """On-disk, content-addressed cache of processed satellite tiles"""
+
+    def __init__(self, cache_dir="structure_folder/tile_cache", max_bytes=512 * 1024 * 1024, revalidate=False):
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._entries = self._load_index()
+        self._refs = {}
+        self._total_bytes = 0
+        for entry in self._entries.values():
+            self._add_ref(entry)
+
+    def _load_index(self):
+        """Load the URL index, starting empty if it is missing or corrupt"""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (IOError, ValueError):
+            return {}
+
+    def tile_key(self, url):
+        """Build the cache key from the lyrs/x/y/z parameters of a tile URL"""
+        params = dict(re.findall(r'(lyrs|x|y|z)=([^&]+)', url))
+        if len(params) == 4:
+            return "&".join(f"{name}={params[name]}" for name in ("lyrs", "x", "y", "z"))
+        return url
+
+    def _add_ref(self, entry):
+        """Count one more index entry pointing at a blob"""
+        digest = entry["digest"]
+        if digest not in self._refs:
+            self._refs[digest] = 0
+            self._total_bytes += entry["size"]
+        self._refs[digest] += 1
+
+    def _drop_ref(self, entry):
+        """Release an index entry and delete its blob once nothing points at it"""
+        digest = entry["digest"]
+        self._refs[digest] -= 1
+        if self._refs[digest] > 0:
+            return
+        del self._refs[digest]
+        self._total_bytes -= entry["size"]
+        try:
+            os.remove(self._blob_path(digest))
+        except OSError:
+            pass
+
+    def _blob_path(self, digest):
+        """Return the on-disk location of a blob"""
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def lookup(self, url):
+        """Return a copy of the cache entry for a URL, or None"""
+        with self._lock:
+            entry = self._entries.get(self.tile_key(url))
+            return dict(entry) if entry else None
+
+    def conditional_headers(self, entry):
+        """Build If-None-Match / If-Modified-Since headers for revalidation"""
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def get(self, url, revalidated=False):
+        """Return cached tile bytes and count a hit, or None if unavailable"""
+        key = self.tile_key(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            try:
+                with open(self._blob_path(entry["digest"]), 'rb') as f:
+                    data = f.read()
+            except (IOError, OSError):
+                # Blob vanished from disk; forget the entry so the tile is fetched again
+                self._drop_ref(self._entries.pop(key))
+                return None
+
+            entry["last_used"] = time.time()
+            self.hits += 1
+            if revalidated:
+                self.revalidated += 1
+            # A 304 carries no body either, so a revalidated hit saves the whole tile too
+            self.bytes_saved += entry.get("source_size", len(data))
+            return data
+
+    def put(self, url, data, etag=None, last_modified=None, source_size=None):
+        """Store processed tile bytes for a URL and evict old entries if over the cap"""
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(digest)
+
+        with self._lock:
+            self.misses += 1
+            key = self.tile_key(url)
+            if key in self._entries:
+                self._drop_ref(self._entries.pop(key))
+            if not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                temp_path = f"{blob_path}.{threading.get_ident()}.tmp"
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, blob_path)
+
+            entry = {
+                "digest": digest,
+                "size": len(data),
+                "source_size": source_size if source_size is not None else len(data),
+                "etag": etag,
+                "last_modified": last_modified,
+                "last_used": time.time()
+            }
+            self._entries[key] = entry
+            self._add_ref(entry)
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries until the referenced blobs fit the size cap"""
+        if self._total_bytes <= self.max_bytes:
+            return
+
+        for key in sorted(self._entries, key=lambda k: self._entries[k]["last_used"]):
+            if self._total_bytes <= self.max_bytes:
+                break
+            self._drop_ref(self._entries.pop(key))
+
+    def flush(self):
+        """Write the URL index to disk"""
+        with self._lock:
+            temp_path = f"{self.index_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f)
+            os.replace(temp_path, self.index_path)
+
+    def stats(self):
+        """Return hit/miss counters and the current cache size"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+                "bytes_saved": self.bytes_saved,
+                "entries": len(self._entries),
+                "size_bytes": self._total_bytes
+            }
@@ -0,0 +1,337 @@
+import csv
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+import supervision as sv
+from detection_store_Rdy import DetectionStore
+
+
+_END = object()
+
+
+class StageStats:
+    """Item count and busy time of one pipeline stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy = 0.0
+
+    def record(self, frames, started):
+        """Count frames handled since the perf_counter value started"""
+        self.frames += frames
+        self.busy += time.perf_counter() - started
+
+    def report(self, wall_time):
+        """Throughput while busy and share of the wall time spent working"""
+        return {
+            "frames": self.frames,
+            "busy_s": round(self.busy, 3),
+            "fps": round(self.frames / self.busy, 2) if self.busy else 0.0,
+            "utilization": round(self.busy / wall_time, 3) if wall_time else 0.0
+        }
+
+
+class FrameGate:
+    """Run the detector on keyframes and on frames that moved since the last detector run"""
+
+    def __init__(self, keyframe_interval=5, motion_threshold=8.0, thumbnail_wh=(64, 36)):
+        self.keyframe_interval = max(1, int(keyframe_interval))
+        self.motion_threshold = motion_threshold
+        self.thumbnail_wh = thumbnail_wh
+        self._reference = None
+        self._reference_index = None
+
+    def _thumbnail(self, frame):
+        """Small grayscale copy used for the frame difference"""
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, self.thumbnail_wh, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def check(self, frame_index, frame):
+        """Return (run_detector, motion_score) for a frame, in frame order"""
+        thumbnail = self._thumbnail(frame)
+        if self._reference is None:
+            # Nothing to compare the first frame with; it always runs the detector
+            motion = 0.0
+        else:
+            # Mean absolute difference against the last frame the detector saw, on 0-255
+            motion = float(np.mean(np.abs(thumbnail - self._reference)))
+
+        run_detector = (
+            self._reference is None
+            or frame_index - self._reference_index >= self.keyframe_interval
+            or motion > self.motion_threshold
+        )
+        if run_detector:
+            self._reference = thumbnail
+            self._reference_index = frame_index
+        return run_detector, motion
+
+
+class TrackExtrapolator:
+    """Predict tracked boxes at skipped frames with a constant-velocity model per tracker id"""
+
+    def __init__(self):
+        self._last = None
+        self._last_index = None
+        self._velocity = None
+
+    def update(self, frame_index, detections):
+        """Record tracked detections from a frame the detector ran on"""
+        velocity = np.zeros((len(detections), 4), dtype=np.float32)
+        if self._last is not None and detections.tracker_id is not None and self._last.tracker_id is not None:
+            previous = {int(tracker_id): box for tracker_id, box in zip(self._last.tracker_id, self._last.xyxy)}
+            gap = frame_index - self._last_index
+            for row, (tracker_id, box) in enumerate(zip(detections.tracker_id, detections.xyxy)):
+                if int(tracker_id) in previous:
+                    velocity[row] = (box - previous[int(tracker_id)]) / gap
+
+        self._last = detections
+        self._last_index = frame_index
+        self._velocity = velocity
+
+    def predict(self, frame_index):
+        """Predict where the last tracked boxes are at a skipped frame"""
+        if self._last is None or len(self._last) == 0:
+            return sv.Detections.empty()
+
+        predicted = self._last[np.arange(len(self._last))]
+        predicted.xyxy = predicted.xyxy + self._velocity * (frame_index - self._last_index)
+        return predicted
+
+
+def _audit_recall(predicted, detected, iou_threshold=0.5):
+    """Share of real detections covered by a predicted box, and their mean IoU"""
+    if len(detected) == 0:
+        return 1.0, 1.0
+    if len(predicted) == 0:
+        return 0.0, 0.0
+    best_iou = sv.box_iou_batch(detected.xyxy, predicted.xyxy).max(axis=1)
+    return float(np.mean(best_iou >= iou_threshold)), float(np.mean(best_iou))
+
+
+class StoreSink:
+    """Columnar stand-in for sv.CSVSink: detections go to a DetectionStore in flushed batches"""
+
+    def __init__(self, store_path, flush_rows=4096):
+        self.store = DetectionStore(store_path, mode="w", flush_rows=flush_rows)
+
+    def append(self, detections, custom_data):
+        # Like CSVSink, every custom_data field becomes a column, e.g. inferred vs. interpolated
+        columns = {name: value for name, value in custom_data.items() if name != "frame_index"}
+        self.store.append(detections, frame_index=custom_data["frame_index"], **columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.store.close()
+
+
+class VideoPipeline:
+    """Decode, infer and encode a video on separate threads joined by bounded queues"""
+
+    def __init__(self, infer, batch_size=4, queue_size=16, gate=None, audit_interval=0, flush_rows=4096):
+        self.infer = infer
+        # Columnar output: detection rows buffered per write to the store
+        self.flush_rows = flush_rows
+        self.batch_size = max(1, int(batch_size))
+        self.queue_size = max(1, int(queue_size))
+        self.gate = gate
+        self.audit_interval = audit_interval
+        self.stats = {}
+        self.gating = {}
+        self._failed = threading.Event()
+        self._errors = []
+
+    def _put(self, target_queue, item):
+        """Block on a full queue (backpressure) but give up if another stage failed"""
+        while not self._failed.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source_queue):
+        """Block on an empty queue but give up if another stage failed"""
+        while not self._failed.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _run_stage(self, target, *args):
+        """Run a stage, recording its error and stopping the others if it fails"""
+        try:
+            target(*args)
+        except Exception as e:
+            self._errors.append(e)
+            self._failed.set()
+
+    def _decode(self, video_path, decoded):
+        """Decoder stage: read frames into the bounded decode queue"""
+        stats = self.stats["decode"]
+        frames = iter(sv.get_video_frames_generator(video_path))
+        frame_index = 0
+        while True:
+            started = time.perf_counter()
+            frame = next(frames, None)
+            if frame is None:
+                break
+            stats.record(1, started)
+            if not self._put(decoded, (frame_index, frame)):
+                return
+            frame_index += 1
+        self._put(decoded, _END)
+
+    def _next_batch(self, decoded):
+        """Wait for one frame, then take whatever else is ready up to batch_size"""
+        first = self._get(decoded)
+        if first is _END:
+            return [], True
+
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                item = decoded.get_nowait()
+            except queue.Empty:
+                break
+            if item is _END:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _inference(self, decoded, inferred):
+        """Inference stage: run batched detection and ByteTrack on decoded frames"""
+        stats = self.stats["inference"]
+        # sv.ByteTrack is removed in supervision 0.31, hence the <0.31 pin in requirements.txt
+        tracker = sv.ByteTrack()
+        extrapolator = TrackExtrapolator()
+        finished = False
+        while not finished:
+            batch, finished = self._next_batch(decoded)
+            if not batch:
+                break
+
+            started = time.perf_counter()
+            # The gate and tracker are stateful, so frames are handled in order on this thread
+            checks = [self.gate.check(index, frame) if self.gate else (True, 0.0) for index, frame in batch]
+            run_frames = [frame for (_, frame), (run_detector, _) in zip(batch, checks) if run_detector]
+            audit_frames = [
+                frame for (index, frame), (run_detector, _) in zip(batch, checks)
+                if not run_detector and self._is_audit_frame(index)
+            ]
+            results = self.infer(run_frames + audit_frames) if run_frames or audit_frames else []
+            run_results = iter(results[:len(run_frames)])
+            audit_results = iter(results[len(run_frames):])
+
+            items = []
+            for (frame_index, frame), (run_detector, motion) in zip(batch, checks):
+                if run_detector:
+                    detections = tracker.update_with_detections(next(run_results))
+                    extrapolator.update(frame_index, detections)
+                else:
+                    # ByteTrack still steps on skipped frames, fed the predicted boxes, so its
+                    # frame count and lost-track buffer advance and it carries the tracks over
+                    detections = tracker.update_with_detections(extrapolator.predict(frame_index))
+                    if self._is_audit_frame(frame_index):
+                        self._record_audit(detections, next(audit_results))
+                self._record_gating(run_detector)
+                items.append((frame_index, frame, detections, run_detector, motion))
+            stats.record(len(batch), started)
+
+            for item in items:
+                if not self._put(inferred, item):
+                    return
+        self._put(inferred, _END)
+
+    def _is_audit_frame(self, frame_index):
+        """Skipped frames the detector still runs on, only to measure interpolation error"""
+        return self.gate is not None and self.audit_interval > 0 and frame_index % self.audit_interval == 0
+
+    def _record_gating(self, run_detector):
+        """Count a frame as inferred or interpolated"""
+        self.gating["frames"] += 1
+        self.gating["inferred" if run_detector else "interpolated"] += 1
+
+    def _record_audit(self, predicted, detected):
+        """Accumulate how well interpolated boxes matched a real detector run"""
+        recall, mean_iou = _audit_recall(predicted, detected)
+        self.gating["audited"] += 1
+        self.gating["audit_recall_sum"] += recall
+        self.gating["audit_iou_sum"] += mean_iou
+
+    def _encode(self, inferred, csv_path, target_path, video_info, store_path=None):
+        """Encoder stage: write CSV rows, or columnar store batches, and annotated frames"""
+        stats = self.stats["encode"]
+        box_annotator = sv.BoxAnnotator()
+        detection_sink = StoreSink(store_path, self.flush_rows) if store_path else sv.CSVSink(csv_path)
+        with detection_sink as sink, sv.VideoSink(target_path, video_info=video_info) as video_sink, \
+                open(csv_path.replace('.csv', '_frames.csv'), 'w', newline='', encoding='utf-8') as frames_file:
+            # One row per frame, so frames without detections still show how they were produced
+            frames_writer = csv.writer(frames_file)
+            frames_writer.writerow(["frame_index", "inferred", "motion", "detections"])
+            while True:
+                item = self._get(inferred)
+                if item is _END:
+                    break
+                started = time.perf_counter()
+                frame_index, frame, detections, run_detector, motion = item
+                sink.append(detections, {"frame_index": frame_index, "inferred": int(run_detector)})
+                frames_writer.writerow([frame_index, int(run_detector), round(motion, 3), len(detections)])
+                video_sink.write_frame(box_annotator.annotate(frame.copy(), detections=detections))
+                stats.record(1, started)
+
+    def _gating_report(self):
+        """Summarize detector calls saved and, if audited, the interpolation error"""
+        gating = self.gating
+        report = {
+            "frames": gating["frames"],
+            "inferred": gating["inferred"],
+            "interpolated": gating["interpolated"],
+            "inference_ratio": round(gating["inferred"] / gating["frames"], 3) if gating["frames"] else 0.0
+        }
+        if gating["audited"]:
+            report["audited"] = gating["audited"]
+            report["audit_recall"] = round(gating["audit_recall_sum"] / gating["audited"], 3)
+            report["audit_mean_iou"] = round(gating["audit_iou_sum"] / gating["audited"], 3)
+        return report
+
+    def run(self, video_path, csv_path, target_path, store_path=None):
+        """Process the whole video and return per-stage throughput; store_path replaces the detections CSV"""
+        self.stats = {name: StageStats(name) for name in ("decode", "inference", "encode")}
+        self.gating = dict.fromkeys(
+            ("frames", "inferred", "interpolated", "audited", "audit_recall_sum", "audit_iou_sum"), 0)
+        self._failed.clear()
+        self._errors = []
+
+        video_info = sv.VideoInfo.from_video_path(video_path)
+        decoded = queue.Queue(maxsize=self.queue_size)
+        inferred = queue.Queue(maxsize=self.queue_size)
+
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=self._run_stage, args=(self._decode, video_path, decoded), daemon=True),
+            threading.Thread(target=self._run_stage,
+                             args=(self._encode, inferred, csv_path, target_path, video_info, store_path),
+                             daemon=True)
+        ]
+        for thread in threads:
+            thread.start()
+        self._run_stage(self._inference, decoded, inferred)
+        for thread in threads:
+            thread.join()
+        wall_time = time.perf_counter() - started
+
+        if self._errors:
+            raise RuntimeError(f"Video pipeline failed: {self._errors[0]}")
+
+        report = {name: stage.report(wall_time) for name, stage in self.stats.items()}
+        report["end_to_end_fps"] = round(self.stats["encode"].frames / wall_time, 2) if wall_time else 0.0
+        report["gating"] = self._gating_report()
+        return report